@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import pickle
+import resource
+import shutil
+import time
+from collections import defaultdict
+
+import numpy
+import torch
+
+from dataloader import DataLoader
+
+#################################################
+# Benchmark the DataLoader on a synthetic data set
+#################################################
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-data_dir', type=str, default='/tmp/PPUU-benchmark', help='where the synthetic data set is made')
+parser.add_argument('-regenerate', action='store_true', help='make the synthetic data set again')
+parser.add_argument('-time_slots', type=int, default=3)
+parser.add_argument('-episodes', type=int, default=200, help='episodes per time slot')
+parser.add_argument('-min_length', type=int, default=50, help='min episode length, in frames')
+parser.add_argument('-max_length', type=int, default=500, help='max episode length, in frames')
+parser.add_argument('-batch_sizes', type=int, nargs='+', default=[8, 32, 64])
+parser.add_argument('-ncond', type=int, nargs='+', default=[20])
+parser.add_argument('-npred', type=int, nargs='+', default=[20, 30])
+parser.add_argument('-devices', type=str, nargs='+', default=['cpu', 'cuda'])
+parser.add_argument('-n_batches', type=int, default=100, help='batches timed per configuration')
+parser.add_argument('-num_workers', type=int, default=0, help='threads assembling batches ahead (0: synchronous)')
+parser.add_argument('-prefetch', type=int, default=4, help='max number of batches assembled ahead')
+parser.add_argument('-cache_size', type=int, default=0, help='MB of whole episodes cached in memory')
+parser.add_argument('-windows_per_episode', type=int, default=1, help='windows sampled from each episode')
+parser.add_argument('-output', type=str, default='benchmark_dataloader.json')
+opt = parser.parse_args()
+opt.debug = False
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # ru_maxrss is in KB on Linux
+
+
+def make_data_set(data_dir):
+    """
+    Dump random episodes in the format of Car.dump_state_image, with as many distinct car sizes as I-80
+    """
+    print(f'[making synthetic data set: {data_dir}]')
+    shutil.rmtree(data_dir, ignore_errors=True)
+    rng = numpy.random.RandomState(0)
+    car_sizes = dict()
+    for slot in range(opt.time_slots):
+        time_slot = f'trajectories-{slot:04d}'
+        os.makedirs(os.path.join(data_dir, time_slot))
+        car_sizes[time_slot] = dict()
+        for car in range(1, opt.episodes + 1):
+            T = rng.randint(opt.min_length, opt.max_length + 1)
+            width, length = rng.randint(4, 8), rng.randint(8, 20)
+            ego_car = torch.zeros(3, 117, 24, dtype=torch.uint8)
+            ego_car[2, 58 - length // 2:58 + length // 2, 12 - width // 2:12 + width // 2] = 255
+            with open(os.path.join(data_dir, time_slot, f'car{car}.pkl'), 'wb') as f:
+                pickle.dump({
+                    'images': torch.from_numpy(rng.randint(0, 256, (T, 3, 117, 24), dtype=numpy.uint8)),
+                    'actions': torch.randn(T, 2),
+                    'lane_cost': torch.rand(T),
+                    'pixel_proximity_cost': torch.rand(T),
+                    'states': torch.randn(T, 7, 4),
+                    'proximity_cost': torch.rand(T),
+                    'mask': torch.ones(T, 7),
+                    'frames': numpy.arange(T),
+                    'ego_car': ego_car,
+                }, f)
+            car_sizes[time_slot][car] = (width, length)
+    torch.save(car_sizes, os.path.join(data_dir, 'car_sizes.pth'))
+
+
+class TimedDataLoader(DataLoader):
+    """
+    DataLoader accumulating the time spent in every stage of the batch assembly
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = defaultdict(float)
+
+    def timed(self, stage, f, *args, device=None):
+        t0 = time.perf_counter()
+        result = f(*args)
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        self.timings[stage] += time.perf_counter() - t0
+        return result
+
+    def sample_windows(self, split, T):
+        return self.timed('sample', super().sample_windows, split, T)
+
+    def gather_batch(self, samples, T, device):
+        # windows are sliced straight into the stacked batch buffers, so slicing and stacking are a single stage
+        return self.timed('slice_stack', super().gather_batch, samples, T, device)
+
+    def transfer_batch(self, staging, device):
+        return self.timed('transfer', super().transfer_batch, staging, device, device=device)
+
+    def make_batch(self, samples, npred, device):
+        return self.timed('make_batch', super().make_batch, samples, npred, device, device=device)
+
+    def normalise_action(self, actions):
+        return self.timed('normalise', super().normalise_action, actions, device=actions.device)
+
+    def normalise_state_vector(self, states):
+        return self.timed('normalise', super().normalise_state_vector, states, device=states.device)
+
+    def normalise_state_image(self, images):
+        return self.timed('normalise', super().normalise_state_image, images, device=images.device)
+
+
+def loader_options():
+    options = argparse.Namespace(**vars(opt))
+    options.batch_size, options.ncond, options.npred = 1, 1, 1  # set by benchmark()
+    return options
+
+
+def batch_bytes(loader, bsize, T):
+    return sum(x.nbytes for x in loader.get_staging_buffers(torch.device('cpu'), bsize, T).values())
+
+
+def benchmark(loader, timed_loader, bsize, ncond, npred, device):
+    for dl in loader, timed_loader:
+        dl.opt.batch_size, dl.opt.ncond, dl.opt.npred = bsize, ncond, npred
+    cuda = device == 'cuda'
+
+    # throughput, through the same path as the training scripts (with opt.num_workers threads)
+    for _ in loader.prefetch_batches('train', min(opt.n_batches, 10), cuda=cuda): pass  # warm up
+    if cuda: torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in loader.prefetch_batches('train', opt.n_batches, cuda=cuda): pass
+    if cuda: torch.cuda.synchronize()
+    elapsed = time.perf_counter() - t0
+
+    # time per stage, synchronously
+    timed_loader.timings.clear()
+    for _ in range(opt.n_batches):
+        timed_loader.get_batch_fm('train', cuda=cuda)
+    t = {k: v / opt.n_batches * 1e3 for k, v in timed_loader.timings.items()}
+    t['other'] = t.pop('make_batch') - t['slice_stack'] - t['transfer'] - t['normalise']
+
+    result = dict(
+        batch_size=bsize, ncond=ncond, npred=npred, device=device,
+        batches_per_s=opt.n_batches / elapsed,
+        mb_per_s=opt.n_batches * batch_bytes(loader, bsize, ncond + npred) / elapsed / 2**20,
+        stages_ms=t,
+        peak_rss_mb=peak_rss_mb(),
+    )
+    print(f'[bsize {bsize} | ncond {ncond} | npred {npred} | {device} | {result["batches_per_s"]:.1f} batches/s | '
+          f'{result["mb_per_s"]:.1f} MB/s | ' + ', '.join(f'{k}: {v:.2f} ms' for k, v in t.items()) + ']')
+    return result
+
+
+if opt.regenerate or not os.path.isdir(opt.data_dir):
+    make_data_set(opt.data_dir)
+
+# the first start after the data set is made (see -regenerate) converts the car*.pkl files into memory-mapped shards
+# and computes splits and stats
+t0 = time.perf_counter()
+DataLoader(None, loader_options(), opt.data_dir)
+first_start_s = time.perf_counter() - t0
+rss_first_start = peak_rss_mb()
+t0 = time.perf_counter()
+loader = DataLoader(None, loader_options(), opt.data_dir)
+start_s = time.perf_counter() - t0
+timed_loader = TimedDataLoader(None, loader_options(), opt.data_dir)
+
+results = dict(
+    options=vars(opt),
+    data_set=dict(
+        episodes=loader.n_episodes,
+        frames=int(loader.episode_length.sum()),
+        mb=sum(os.path.getsize(os.path.join(s.path, f)) for s in loader.shards for f in os.listdir(s.path)) / 2**20,
+    ),
+    startup=dict(first_start_s=first_start_s, start_s=start_s, peak_rss_mb=rss_first_start),
+    runs=[],
+)
+print(f'[startup: {first_start_s:.2f} s the first time, {start_s:.3f} s then]')
+
+devices = [d for d in opt.devices if d != 'cuda' or torch.cuda.is_available()]
+for device in devices:
+    for bsize in opt.batch_sizes:
+        for ncond in opt.ncond:
+            for npred in opt.npred:
+                results['runs'].append(benchmark(loader, timed_loader, bsize, ncond, npred, device))
+
+with open(opt.output, 'w') as f:
+    json.dump(results, f, indent=2)
+print(f'[results saved in {opt.output}]')
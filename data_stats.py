@@ -0,0 +1,165 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import torch
+
+import shards
+
+
+class RunningStats:
+    """
+    Mean and standard deviation of a stream of samples, in a single pass and in constant memory
+
+    Each chunk is reduced on its own and merged with the pairwise update of Chan et al., which is numerically stable
+    and lets partial results computed in parallel (or at different times) be merged exactly.
+    """
+
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = mean  # (d,) float64
+        self.m2 = m2  # (d,) float64, sum of squared differences from the mean
+
+    def update(self, x):
+        """
+        :param x: (n, d) samples
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        if len(x) == 0: return self
+        mean = x.mean(0)
+        return self.merge(RunningStats(len(x), mean, ((x - mean) ** 2).sum(0)))
+
+    def merge(self, other):
+        if other.count == 0: return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.m2 / (self.count - 1))  # unbiased, as torch.std
+
+    def state_dict(self):
+        return dict(count=self.count, mean=torch.from_numpy(self.mean), m2=torch.from_numpy(self.m2))
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state['count'], state['mean'].numpy(), state['m2'].numpy())
+
+
+def shard_stats(shard, episodes, chunk_rows=1 << 16):
+    """
+    Accumulate actions and ego-car states of some episodes of a shard, reading about chunk_rows frames at a time
+    :param shard: shards.ShardStore
+    :param episodes: local indices of the episodes in the shard
+    :return: actions and states RunningStats
+    """
+    actions, states = RunningStats(), RunningStats()
+    chunk = []
+
+    def flush():
+        rows = numpy.concatenate(chunk)
+        actions.update(shard.actions[rows])
+        states.update(shard.states[rows, 0])
+        chunk.clear()
+
+    # visit episodes by index, which is their storage order unless some were replaced, so that the shard is read
+    # (mostly) sequentially
+    index = shard.index[numpy.sort(numpy.asarray(episodes, dtype=numpy.int64))]
+    n_rows = 0
+    for offset, length in index:
+        chunk.append(numpy.arange(offset, offset + length))
+        n_rows += length
+        if n_rows >= chunk_rows:
+            flush()
+            n_rows = 0
+    if chunk: flush()
+    return actions, states
+
+
+def time_slot(shard):
+    """
+    Name of the time slot directory of a shard, which identifies it within its data set
+    """
+    return os.path.basename(os.path.dirname(os.path.normpath(shard.path)))
+
+
+def compute_stats(shard_list, episodes, workers=None, stats=None):
+    """
+    Compute (or update) the data set stats from some episodes of some shards, one shard per thread
+    :param shard_list: list of shards.ShardStore
+    :param episodes: list of local episode indices, one array per shard
+    :param workers: number of threads, defaults to one per shard
+    :param stats: stats to update, as returned by a previous call or loaded from data_stats.pth, which must not
+                  include any of the shards already
+    :return: dict with a_mean, a_std, s_mean, s_std and the accumulators needed to update them later, including the
+             time slots they were computed from
+    """
+    time_slots = [time_slot(shard) for shard in shard_list]
+    merged = []
+    if stats is not None:
+        if 'time_slots' not in stats.get('accumulators', dict()):
+            raise ValueError('stats computed before they could be updated, they need to be computed from scratch')
+        merged = stats['accumulators']['time_slots']
+    repeated = sorted(set(merged) & set(time_slots) | {t for t in time_slots if time_slots.count(t) > 1})
+    if repeated:
+        raise ValueError(f'time slots already in the stats: {", ".join(repeated)}')
+    with ThreadPoolExecutor(workers or max(len(shard_list), 1)) as pool:
+        partial = list(pool.map(shard_stats, shard_list, episodes))
+    actions = RunningStats.from_state_dict(stats['accumulators']['actions']) if stats else RunningStats()
+    states = RunningStats.from_state_dict(stats['accumulators']['states']) if stats else RunningStats()
+    # merging in a fixed order keeps the result deterministic
+    for a, s in partial:
+        actions.merge(a)
+        states.merge(s)
+    return {
+        'a_mean': torch.from_numpy(actions.mean).float(),
+        'a_std': torch.from_numpy(actions.std).float(),
+        's_mean': torch.from_numpy(states.mean).float(),
+        's_std': torch.from_numpy(states.std).float(),
+        'accumulators': {
+            'actions': actions.state_dict(),
+            'states': states.state_dict(),
+            'time_slots': merged + time_slots,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='add the training episodes of some time slots to data_stats.pth')
+    parser.add_argument('-dataset', type=str, default='i80', help='i80, us101, or path to a data set directory')
+    parser.add_argument('-time_slots', type=str, nargs='+', required=True, help='time slot directories to add')
+    opt = parser.parse_args()
+
+    # the same episodes, and the same training split, as the DataLoader: new episodes are split and added to splits.pth
+    import dataloader
+    data_dir = shards.data_set_dir(opt.dataset)
+    data_files = sorted(next(os.walk(data_dir))[1])
+    unknown = set(opt.time_slots) - set(data_files)
+    if unknown:
+        parser.error(f'no time slot {", ".join(sorted(unknown))} in {data_dir}')
+    shard_list = [shards.open_shard(f'{data_dir}/{df}') for df in data_files]
+    offsets = numpy.cumsum([0] + [s.n_episodes for s in shard_list])
+    train = dataloader.data_splits(data_dir, [id_ for s in shard_list for id_ in s.ids])['train_indx']
+    add, episodes = [], []
+    for k, df in enumerate(data_files):
+        if df not in opt.time_slots: continue
+        add.append(shard_list[k])
+        episodes.append(train[(offsets[k] <= train) & (train < offsets[k + 1])] - offsets[k])
+        print(f'[{df}: {len(episodes[-1])}/{shard_list[k].n_episodes} training episodes]')
+
+    stats_path = os.path.join(data_dir, 'data_stats.pth')
+    stats = torch.load(stats_path) if os.path.isfile(stats_path) else None
+    try:
+        stats = compute_stats(add, episodes, stats=stats)
+    except ValueError as e:
+        parser.error(str(e))
+    torch.save(stats, stats_path)
+    print(f'[saved data stats: {stats_path}]')
@@ -1,6 +1,95 @@
 import sys
 import numpy, random, pdb, math, pickle, glob, time, os, re
+import threading
 import torch
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import data_stats
+import shards
+
+
+class EpisodeCache:
+    """
+    Least recently used episodes, copied out of the memory-mapped shards, up to capacity bytes
+    Thread safe, episodes are loaded outside of the lock.
+    """
+
+    def __init__(self, capacity, load):
+        self.capacity = capacity
+        self.load = load  # episode -> dict of arrays
+        self.episodes = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def get(self, s):
+        with self.lock:
+            episode = self.episodes.get(s)
+            if episode is not None:
+                self.episodes.move_to_end(s)
+                self.hits += 1
+                return episode
+            self.misses += 1
+        episode = self.load(s)
+        with self.lock:
+            if s not in self.episodes:
+                self.episodes[s] = episode
+                self.nbytes += sum(x.nbytes for x in episode.values())
+            while self.nbytes > self.capacity and len(self.episodes) > 1:
+                _, evicted = self.episodes.popitem(last=False)
+                self.nbytes -= sum(x.nbytes for x in evicted.values())
+                self.evictions += 1
+        return episode
+
+    def __repr__(self):
+        hit_rate = self.hits / max(self.hits + self.misses, 1)
+        size, capacity = self.nbytes / 2**20, self.capacity / 2**20
+        return (f'[episode cache: {len(self.episodes)} episodes, {size:.0f}/{capacity:.0f} MB'
+                f' | hits: {self.hits}, misses: {self.misses}, hit rate: {hit_rate:.3f}, evictions: {self.evictions}]')
+
+
+SPLITS = 'train_indx', 'valid_indx', 'test_indx'
+
+
+def data_splits(data_dir, ids, save=True):
+    """
+    Train, validation and test episodes of a data set, loaded from splits.pth, where episodes new to the data set (e.g.
+    of a new time slot) are split and added, without changing the split of the others
+    :param data_dir: data set directory
+    :param ids: episode ids of the data set, in the order of DataLoader.ids
+    :param save: save splits.pth, if episodes were added or their order changed
+    :return: dict with ids, and train_indx, valid_indx and test_indx, indices in ids
+    """
+    splits_path = data_dir + '/splits.pth'
+    splits = dict(ids=[], **{split: [] for split in SPLITS})
+    if os.path.exists(splits_path):
+        print(f'[loading data splits: {splits_path}]')
+        splits = torch.load(splits_path)
+        if 'ids' not in splits:
+            # splits of earlier versions index the episodes of the time slots in (unsorted) os.walk order
+            walk_order = {time_slot: k for k, time_slot in enumerate(next(os.walk(data_dir))[1])}
+            walk_ids = sorted(ids, key=lambda id_: walk_order.get(id_.split('/')[-2], len(walk_order)))
+            splits['ids'] = walk_ids[:sum(len(splits[split]) for split in SPLITS)]
+    position = {id_: s for s, id_ in enumerate(ids)}
+    stored = splits['ids']
+    indices = {split: [position[stored[i]] for i in splits[split] if i < len(stored) and stored[i] in position]
+               for split in SPLITS}
+    stored_ids = set(stored)
+    new = numpy.array([s for s, id_ in enumerate(ids) if id_ not in stored_ids], dtype=numpy.int64)
+    if len(new):
+        print(f'[splitting {len(new)} new episodes]')
+        rgn = numpy.random.RandomState(0)
+        perm = new[rgn.permutation(len(new))]
+        n_train = int(math.floor(len(new) * 0.8))
+        n_valid = int(math.floor(len(new) * 0.1))
+        indices['train_indx'] += perm[0 : n_train].tolist()
+        indices['valid_indx'] += perm[n_train : n_train + n_valid].tolist()
+        indices['test_indx'] += perm[n_train + n_valid :].tolist()
+    splits = dict(ids=list(ids), **{split: numpy.array(indices[split], dtype=numpy.int64) for split in SPLITS})
+    if save and (len(new) or stored != splits['ids']):
+        torch.save(splits, splits_path)
+    return splits
 
 
 class DataLoader:
@@ -8,102 +97,62 @@ class DataLoader:
         if opt.debug:
             single_shard = True
         self.opt = opt
-        self.random = random.Random()
-        self.random.seed(12345)  # use this so that the same batches will always be picked
+        # Distributed sampling: each process draws windows only from its own share of the episodes, see set_epoch()
+        self.rank = int(getattr(opt, 'rank', os.environ.get('RANK', 0)))
+        self.world_size = int(getattr(opt, 'world_size', os.environ.get('WORLD_SIZE', 1)))
+        self.epoch = 0
+        # use this so that the same batches will always be picked
+        self.random = numpy.random.RandomState(12345 if self.world_size == 1 else (12345, self.rank))
+        self.workers = None  # thread pool for prefetch_batches(), created on first use
 
-        if dataset == 'i80' or dataset == 'us101':
-            data_dir = f'traffic-data/state-action-cost/data_{dataset}_v0'
-        else:
-            data_dir = dataset
+        data_dir = shards.data_set_dir(dataset)
 
         if single_shard:
             # quick load for debugging
-            data_files = [f'{next(os.walk(data_dir))[1][0]}.txt/']
+            data_files = [sorted(next(os.walk(data_dir))[1])[0]]
         else:
-            data_files = next(os.walk(data_dir))[1]
+            data_files = sorted(next(os.walk(data_dir))[1])  # so that episodes keep their index
 
-        self.images = []
-        self.actions = []
-        self.costs = []
-        self.states = []
+        # Episodes live in memory-mapped shards, see shards.py for the on-disk layout.
+        # Global episode s is episode self.episode_local[s] of shard self.shards[self.episode_shard[s]].
+        self.shards = []
         self.ids = []
-        self.ego_car_images = []
+        episode_shard, episode_local, index, ego_car_masks, episode_ego_car = [], [], [], [], []
+        n_masks = 0
         for df in data_files:
-            combined_data_path = f'{data_dir}/{df}/all_data.pth'
-            if os.path.isfile(combined_data_path):
-                print(f'[loading data shard: {combined_data_path}]')
-                data = torch.load(combined_data_path)
-                self.images += data.get('images')
-                self.actions += data.get('actions')
-                self.costs += data.get('costs')
-                self.states += data.get('states')
-                self.ids += data.get('ids')
-                self.ego_car_images += data.get('ego_car')
-            else:
-                print(data_dir)
-                images = []
-                actions = []
-                costs = []
-                states = []
-                ids = glob.glob(f'{data_dir}/{df}/car*.pkl')
-                ids.sort()
-                ego_car_images = []
-                for f in ids:
-                    print(f'[loading {f}]')
-                    fd = pickle.load(open(f, 'rb'))
-                    Ta = fd['actions'].size(0)
-                    Tp = fd['pixel_proximity_cost'].size(0)
-                    Tl = fd['lane_cost'].size(0)
-                    # assert Ta == Tp == Tl  # TODO Check why there are more costs than actions
-                    # if not(Ta == Tp == Tl): pdb.set_trace()
-                    images.append(fd['images'])
-                    actions.append(fd['actions'])
-                    costs.append(torch.cat((
-                        fd.get('pixel_proximity_cost')[:Ta].view(-1, 1),
-                        fd.get('lane_cost')[:Ta].view(-1, 1),
-                    ), 1),)
-                    states.append(fd['states'])
-                    ego_car_images.append(fd['ego_car'])
-
-                print(f'Saving {combined_data_path} to disk')
-                torch.save({
-                    'images': images,
-                    'actions': actions,
-                    'costs': costs,
-                    'states': states,
-                    'ids': ids,
-                    'ego_car': ego_car_images,
-                }, combined_data_path)
-                self.images += images
-                self.actions += actions
-                self.costs += costs
-                self.states += states
-                self.ids += ids
-                self.ego_car_images += ego_car_images
-
-        self.n_episodes = len(self.images)
+            shard = shards.open_shard(f'{data_dir}/{df}')
+            episode_shard.append(numpy.full(shard.n_episodes, len(self.shards)))
+            episode_local.append(numpy.arange(shard.n_episodes))
+            index.append(shard.index)
+            if shard.n_episodes > 0:
+                ego_car_masks.append(shard.ego_car_masks)
+                episode_ego_car.append(shard.ego_car_index.astype(numpy.int64) + n_masks)
+                n_masks += len(shard.ego_car_masks)
+            self.ids += shard.ids
+            self.shards.append(shard)
+        self.episode_shard = numpy.concatenate(episode_shard)
+        self.episode_local = numpy.concatenate(episode_local)
+        index = numpy.concatenate(index)
+        self.episode_offset = index[:, 0]
+        self.episode_length = index[:, 1]
+        # Ego car masks are only a few, one per car size: episode s uses self.ego_car_masks[self.episode_ego_car[s]]
+        self.ego_car_masks = torch.from_numpy(numpy.concatenate(ego_car_masks))
+        self.episode_ego_car = numpy.concatenate(episode_ego_car)
+        self.device_ego_car_masks = dict()  # device -> normalised self.ego_car_masks
+        self.device_stats = dict()  # device -> normalisation constants, see get_normalisation()
+        self.staging = threading.local()  # per thread pinned host buffers, see get_staging_buffers()
+
+        # Only the episode index is read so far. Windows are then read straight from the memory-mapped shards, through
+        # the OS page cache, or, with opt.cache_size (MB), copied from whole episodes kept in a bounded LRU cache.
+        cache_size = getattr(opt, 'cache_size', 0)
+        self.cache = EpisodeCache(cache_size * 2**20, self.load_episode) if cache_size > 0 else None
+
+        self.n_episodes = len(self.ids)
         print(f'Number of episodes: {self.n_episodes}')
-        splits_path = data_dir + '/splits.pth'
-        if os.path.exists(splits_path):
-            print(f'[loading data splits: {splits_path}]')
-            self.splits = torch.load(splits_path)
-            self.train_indx = self.splits.get('train_indx')
-            self.valid_indx = self.splits.get('valid_indx')
-            self.test_indx = self.splits.get('test_indx')
-        else:
-            print('[generating data splits]')
-            rgn = numpy.random.RandomState(0)
-            perm = rgn.permutation(self.n_episodes)
-            n_train = int(math.floor(self.n_episodes * 0.8))
-            n_valid = int(math.floor(self.n_episodes * 0.1))
-            self.train_indx = perm[0 : n_train]
-            self.valid_indx = perm[n_train : n_train + n_valid]
-            self.test_indx = perm[n_train + n_valid :]
-            torch.save(dict(
-                train_indx=self.train_indx,
-                valid_indx=self.valid_indx,
-                test_indx=self.test_indx,
-            ), splits_path)
+        self.splits = data_splits(data_dir, self.ids, save=not single_shard)
+        self.train_indx = self.splits.get('train_indx')
+        self.valid_indx = self.splits.get('valid_indx')
+        self.test_indx = self.splits.get('test_indx')
 
         stats_path = data_dir + '/data_stats.pth'
         if os.path.isfile(stats_path):
@@ -114,28 +163,131 @@ class DataLoader:
             self.s_mean = stats.get('s_mean')
             self.s_std = stats.get('s_std')
         else:
-            print('[computing action stats]')
-            all_actions = []
-            for i in self.train_indx:
-                all_actions.append(self.actions[i])
-            all_actions = torch.cat(all_actions, 0)
-            self.a_mean = torch.mean(all_actions, 0)
-            self.a_std = torch.std(all_actions, 0)
-            print('[computing state stats]')
-            all_states = []
-            for i in self.train_indx:
-                all_states.append(self.states[i][:, 0])
-            all_states = torch.cat(all_states, 0)
-            self.s_mean = torch.mean(all_states, 0)
-            self.s_std = torch.std(all_states, 0)
-            torch.save({'a_mean': self.a_mean,
-                        'a_std': self.a_std,
-                        's_mean': self.s_mean,
-                        's_std': self.s_std}, stats_path)
+            print('[computing data stats]')
+            train = numpy.asarray(self.train_indx)
+            episodes = [self.episode_local[train[self.episode_shard[train] == k]] for k in range(len(self.shards))]
+            stats = data_stats.compute_stats(self.shards, episodes)
+            self.a_mean = stats['a_mean']
+            self.a_std = stats['a_std']
+            self.s_mean = stats['s_mean']
+            self.s_std = stats['s_std']
+            torch.save(stats, stats_path)
 
         car_sizes_path = data_dir + '/car_sizes.pth'
         print(f'[loading car sizes: {car_sizes_path}]')
         self.car_sizes = torch.load(car_sizes_path)
+        # Car size of every episode, parsed once from the episode ids
+        sizes, missing = [], 0
+        for id_ in self.ids:
+            splits = id_.split('/')
+            time_slot = splits[-2]
+            car_id = int(re.findall(r'car(\d+).pkl', splits[-1])[0])
+            size = self.car_sizes.get(time_slot, {}).get(car_id)
+            if size is None:
+                size, missing = (math.nan, math.nan), missing + 1
+            sizes.append([size[0], size[1]])
+        if missing: print(f'[warning: {missing} episodes have no car size]')
+        self.episode_car_size = torch.tensor(sizes)
+        self.valid_episodes = dict()  # (split, T) -> episodes of split at least T frames long
+
+    def get_episode(self, field, s):
+        """
+        Memory-mapped array of a given field of episode s (no data is read until accessed)
+        """
+        shard = self.shards[self.episode_shard[s]]
+        if field in shards.EPISODE_FIELDS:
+            return getattr(shard, field)[self.episode_local[s]]
+        offset = self.episode_offset[s]
+        return getattr(shard, field)[offset : offset + self.episode_length[s]]
+
+    def load_episode(self, s):
+        """
+        Copy of the frame fields of episode s, with the ego car state only
+        """
+        episode = {f: numpy.array(self.get_episode(f, s)) for f in ('images', 'actions', 'costs')}
+        episode['states'] = numpy.array(self.get_episode('states', s)[:, 0])
+        return episode
+
+    def gather_cached_windows(self, s, t, T, out):
+        """
+        Copy the windows of T frames starting at frames t of the episodes s into the arrays of the out dict, through
+        the episode cache
+        """
+        for b, (s_, t_) in enumerate(zip(s, t)):
+            episode = self.cache.get(s_)
+            for field, x in out.items():
+                x[b] = episode[field][t_ : t_ + T]
+        return out
+
+    def gather_windows(self, field, s, rows, out):
+        """
+        Copy rows of a given field of the episodes s into out, reading from each shard at once
+        :param s: (batch_size,) episodes
+        :param rows: (batch_size, ...) rows to read, relative to each episode shard
+        :param out: (batch_size, ...) output array
+        """
+        shard_idx = self.episode_shard[s]
+        for k in numpy.unique(shard_idx):
+            mask = shard_idx == k
+            data = getattr(self.shards[k], field)
+            out[mask] = data[rows[mask], 0] if field == 'states' else data[rows[mask]]  # discard 6 neighbouring cars
+        return out
+
+    def get_split(self, split):
+        if split == 'train':
+            return self.train_indx
+        elif split == 'valid':
+            return self.valid_indx
+        elif split == 'test':
+            return self.test_indx
+
+    def get_valid_episodes(self, split, T):
+        key = split, T
+        if key not in self.valid_episodes:
+            indx = numpy.asarray(self.get_split(split))
+            if self.world_size > 1:
+                # Same permutation in every process, so that shares do not overlap, and a new one every epoch
+                perm = numpy.random.RandomState((12345, self.epoch)).permutation(len(indx))
+                indx = indx[perm[self.rank::self.world_size]]
+            self.valid_episodes[key] = indx[self.episode_length[indx] >= T]
+        return self.valid_episodes[key]
+
+    def set_epoch(self, epoch):
+        """
+        Split the episodes of every split anew among the world_size processes (opt.rank and opt.world_size, or the RANK
+        and WORLD_SIZE environment variables), each process getting a disjoint share. No-op for a single process.
+        """
+        self.epoch = epoch
+        self.valid_episodes = dict()
+
+    def state_dict(self):
+        """
+        Sampler state, to be saved in checkpoints. Exhaust prefetch_batches() first: queued batches are already drawn.
+        """
+        return dict(rank=self.rank, world_size=self.world_size, epoch=self.epoch, random=self.random.get_state())
+
+    def load_state_dict(self, state):
+        self.set_epoch(state['epoch'])
+        if (state['rank'], state['world_size']) == (self.rank, self.world_size):
+            self.random.set_state(state['random'])
+        else:
+            print(f'[warning: sampler state saved by rank {state["rank"]} of {state["world_size"]}, '
+                  f'not restoring its random stream in rank {self.rank} of {self.world_size}]')
+
+    def sample_windows(self, split, T):
+        """
+        Draw batch_size (episode, first frame) pairs of windows T frames long from a given split, taking
+        opt.windows_per_episode windows from each episode
+        This is the only place where self.random is used, so batches depend on the sequence of calls only
+        :return: (batch_size,) episodes and (batch_size,) first frames
+        """
+        valid = self.get_valid_episodes(split, T)
+        assert len(valid) > 0, f'No {split} episode is at least {T} frames long'
+        # Several windows per episode make the batch read fewer episodes, which keeps the episode cache hit rate high
+        k = getattr(self.opt, 'windows_per_episode', 1)
+        s = valid[self.random.randint(len(valid), size=-(-self.opt.batch_size // k))].repeat(k)[:self.opt.batch_size]
+        t = (self.random.random_sample(self.opt.batch_size) * (self.episode_length[s] - T + 1)).astype(numpy.int64)
+        return s, t
 
     # get batch to use for forward modeling
     # a sequence of ncond given states, a sequence of npred actions,
@@ -145,68 +297,71 @@ class DataLoader:
         # Choose the correct device
         device = torch.device('cuda') if cuda else torch.device('cpu')
 
-        if split == 'train':
-            indx = self.train_indx
-        elif split == 'valid':
-            indx = self.valid_indx
-        elif split == 'test':
-            indx = self.test_indx
+        if npred == -1:
+            npred = self.opt.npred
+
+        samples = self.sample_windows(split, self.opt.ncond + npred)
+        return self.make_batch(samples, npred, device)
+
+    def prefetch_batches(self, split, n_batches, npred=-1, cuda=True):
+        """
+        Yield the same n_batches batches as n_batches consecutive get_batch_fm calls, but have them assembled ahead of
+        time by opt.num_workers threads, with up to opt.prefetch batches queued.
+        Windows are still sampled sequentially, in this thread, so the random stream is consumed in the same order.
+        Do not interleave other get_batch_fm calls before the generator is exhausted (queued batches are already drawn).
+        """
+        num_workers = getattr(self.opt, 'num_workers', 0)
+        if num_workers <= 0:
+            for _ in range(n_batches):
+                yield self.get_batch_fm(split, npred, cuda)
+            return
 
+        device = torch.device('cuda') if cuda else torch.device('cpu')
         if npred == -1:
             npred = self.opt.npred
+        if self.workers is None:
+            self.workers = ThreadPoolExecutor(num_workers, thread_name_prefix='DataLoader')
+        prefetch = max(getattr(self.opt, 'prefetch', 0), num_workers)
+
+        queue = deque()
+        submitted = 0
+        while submitted < n_batches or queue:
+            while submitted < n_batches and len(queue) < prefetch:
+                samples = self.sample_windows(split, self.opt.ncond + npred)
+                queue.append(self.workers.submit(self.make_batch, samples, npred, device))
+                submitted += 1
+            yield queue.popleft().result()
 
-        images, states, actions, costs, ids, sizes, ego_cars = [], [], [], [], [], [], []
-        nb = 0
+    def make_batch(self, samples, npred, device):
+        """
+        Slice, stack, normalise and send to device the windows picked by sample_windows
+        """
+        s, t = samples
         T = self.opt.ncond + npred
-        while nb < self.opt.batch_size:
-            s = self.random.choice(indx)
-            # min is important since sometimes numbers do not align causing issues in stack operation below
-            episode_length = min(self.images[s].size(0), self.states[s].size(0))
-            if episode_length >= T:
-                t = self.random.randint(0, episode_length - T)
-                images.append(self.images[s][t : t + T].to(device))
-                actions.append(self.actions[s][t : t + T].to(device))
-                states.append(self.states[s][t : t + T, 0].to(device))  # discard 6 neighbouring cars
-                costs.append(self.costs[s][t : t + T].to(device))
-                ids.append(self.ids[s])
-                ego_cars.append(self.ego_car_images[s].to(device))
-                splits = self.ids[s].split('/')
-                time_slot = splits[-2]
-                car_id = int(re.findall(r'car(\d+).pkl', splits[-1])[0])
-                size = self.car_sizes[time_slot][car_id]
-                sizes.append([size[0], size[1]])
-                nb += 1
-
-        # Pile up stuff
-        images  = torch.stack(images)
-        states  = torch.stack(states)
-        actions = torch.stack(actions)
-        sizes   = torch.tensor(sizes)
-        ego_cars = torch.stack(ego_cars)
-
-        # Normalise actions, state_vectors, state_images
+        staging = self.gather_batch(samples, T, device)
+        images, states, actions, costs, ego_cars = self.transfer_batch(staging, device)
+        ego_cars = self.get_ego_car_masks(device)[ego_cars]
+        ids = [self.ids[i] for i in s]
+        sizes = self.episode_car_size[torch.from_numpy(s)]
+
+        # Normalise actions and state_vectors (in place, these are copies already)
         if not self.opt.debug:
             actions = self.normalise_action(actions)
             states = self.normalise_state_vector(states)
-        images = self.normalise_state_image(images)
-        ego_cars = self.normalise_state_image(ego_cars)
-
-        costs = torch.stack(costs)
 
         # |-----ncond-----||------------npred------------||
         # ^                ^                              ^
         # 0               t0                             t1
         t0 = self.opt.ncond
         t1 = T
-        input_images  = images [:,   :t0].float().contiguous()
+        input_images  = self.normalise_state_image(images[:,   :t0])
         input_states  = states [:,   :t0].float().contiguous()
-        target_images = images [:, t0:t1].float().contiguous()
+        target_images = self.normalise_state_image(images[:, t0:t1])
         target_states = states [:, t0:t1].float().contiguous()
         target_costs  = costs  [:, t0:t1].float().contiguous()
         t0 -= 1; t1 -= 1
         actions       = actions[:, t0:t1].float().contiguous()
         # input_actions = actions[:, :t0].float().contiguous()
-        ego_cars = ego_cars.float().contiguous()
         #          n_cond                      n_pred
         # <---------------------><---------------------------------->
         # .                     ..                                  .
@@ -237,19 +392,100 @@ class DataLoader:
 
         return [input_images, input_states, ego_cars], actions, [target_images, target_states, target_costs], ids, sizes
 
+    def gather_batch(self, samples, T, device):
+        """
+        Gather the windows of T frames picked by sample_windows into host tensors of the final batch shape
+        :return: dict of images, states, actions, costs and ego_car (mask indices) host tensors
+        """
+        s, t = samples
+        staging = self.get_staging_buffers(device, len(s), T)
+        host = {field: x.numpy() for field, x in staging.items()}
+        if self.cache is not None:
+            self.gather_cached_windows(s, t, T, dict(images=host['images'], states=host['states'],
+                                                     actions=host['actions'], costs=host['costs']))
+        else:
+            rows = (self.episode_offset[s] + t)[:, None] + numpy.arange(T)
+            for field in 'images', 'states', 'actions', 'costs':
+                self.gather_windows(field, s, rows, host[field])
+        host['ego_car'][:] = self.episode_ego_car[s]
+        return staging
+
+    def transfer_batch(self, staging, device):
+        """
+        One host to device copy per field, asynchronous for CUDA devices
+        :return: images, states, actions, costs and ego_car device tensors
+        """
+        fields = 'images', 'states', 'actions', 'costs', 'ego_car'
+        tensors = [staging[field].to(device, non_blocking=True) for field in fields]
+        self.release_staging_buffers(device, *staging['images'].shape[:2])
+        return tensors
+
+    def get_staging_buffers(self, device, bsize, T):
+        """
+        Host tensors a batch is gathered into before being sent to device
+        For CUDA devices, they are pinned, so that copies are asynchronous, and reused by every batch of the same size
+        made by the same thread, once the copies of the previous one are over. Otherwise, they are new at every batch,
+        as tensors sent to the CPU are the host tensors themselves.
+        """
+        shard = self.shards[0]
+        shapes = dict(
+            images=((bsize, T, *shard.images.shape[1:]), torch.uint8),
+            states=((bsize, T, shard.states.shape[-1]), torch.float32),
+            actions=((bsize, T, *shard.actions.shape[1:]), torch.float32),
+            costs=((bsize, T, *shard.costs.shape[1:]), torch.float32),
+            ego_car=((bsize,), torch.int64),
+        )
+        if device.type != 'cuda':
+            return {field: torch.empty(shape, dtype=dtype) for field, (shape, dtype) in shapes.items()}
+        buffers = self.staging.__dict__.setdefault('buffers', dict())
+        key = device, bsize, T
+        if key not in buffers:
+            buffers[key] = (
+                {field: torch.empty(shape, dtype=dtype, pin_memory=True) for field, (shape, dtype) in shapes.items()},
+                torch.cuda.Event(),
+            )
+        staging, copied = buffers[key]
+        copied.synchronize()  # wait for the copies of the previous batch out of these buffers
+        return staging
+
+    def release_staging_buffers(self, device, bsize, T):
+        if device.type == 'cuda':
+            self.staging.buffers[device, bsize, T][1].record()
+
+    def get_normalisation(self, device):
+        """
+        Means and standard deviations of actions and ego car states, copied to each device only once
+        """
+        if device not in self.device_stats:
+            self.device_stats[device] = dict(
+                a_mean=self.a_mean.to(device), a_std=(1e-8 + self.a_std).to(device),
+                s_mean=self.s_mean.to(device), s_std=(1e-8 + self.s_std).to(device),
+            )
+        return self.device_stats[device]
+
+    def get_ego_car_masks(self, device):
+        """
+        Normalised (n_masks, 117, 24) ego car masks, copied to each device only once
+        """
+        if device not in self.device_ego_car_masks:
+            self.device_ego_car_masks[device] = self.normalise_state_image(self.ego_car_masks.to(device))
+        return self.device_ego_car_masks[device]
+
     @staticmethod
     def normalise_state_image(images):
         return images.float().div_(255.0)
 
     def normalise_state_vector(self, states):
-        shape = (1, 1, 4) if states.dim() == 3 else (1, 4)  # dim = 3: state sequence, dim = 2: single state
-        states -= self.s_mean.view(*shape).expand(states.size()).to(states.device)
-        states /= (1e-8 + self.s_std.view(*shape).expand(states.size())).to(states.device)
+        # broadcasts over both state sequences and single states
+        stats = self.get_normalisation(states.device)
+        states -= stats['s_mean']
+        states /= stats['s_std']
         return states
 
     def normalise_action(self, actions):
-        actions -= self.a_mean.view(1, 1, 2).expand(actions.size()).to(actions.device)
-        actions /= (1e-8 + self.a_std.view(1, 1, 2).expand(actions.size())).to(actions.device)
+        stats = self.get_normalisation(actions.device)
+        actions -= stats['a_mean']
+        actions /= stats['a_std']
         return actions
 
 
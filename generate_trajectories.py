@@ -21,6 +21,8 @@ parser.add_argument('-fps', type=int, default=30)
 parser.add_argument('-time_slot', type=int, default=0)
 parser.add_argument('-map', type=str, default='i80', choices={'ai', 'i80', 'us101', 'lanker', 'peach'})
 parser.add_argument('-delta_t', type=float, default=0.1)
+parser.add_argument('-vectorised', type=int, default=0, help='integrate all vehicles at once')
+parser.add_argument('-batched_views', type=int, default=0, help='extract all state images at once')
 opt = parser.parse_args()
 
 opt.state_image = (opt.state_image == 1)
@@ -41,6 +43,8 @@ kwargs = dict(
     traffic_rate=opt.traffic_rate,
     data_dir=opt.data_dir,
     delta_t=opt.delta_t,
+    vectorised=opt.vectorised,
+    batched_views=opt.batched_views,
 )
 
 register(
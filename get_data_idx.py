@@ -12,7 +12,7 @@ dataloader = DataLoader(None, opt, 'i80')
 print('> Loading splits')
 splits = torch.load('/home/atcold/vLecunGroup/nvidia-collab/traffic-data-atcold/data_i80_v0/splits.pth')
 
-for split in splits:
+for split in ('train_indx', 'valid_indx', 'test_indx'):
     data_dict = dict()
     print(f'> Building {split}')
     for idx in splits[split]:
@@ -5,13 +5,15 @@ import torch
 from random import choice, randrange
 
 from custom_graphics import draw_dashed_line
-from traffic_gym import Simulator, Car, colours
+from traffic_gym import Simulator, Car, History, NeighbourIndex, colours
 import pygame
 import pandas as pd
 import numpy as np
 import pdb, random
 import bisect
 import pdb, pickle, os, re
+import hashlib, json, shutil
+import trajectories
 
 # Conversion LANE_W from real world to pixels
 # A US highway lane width is 3.7 metres, here 50 pixels
@@ -30,25 +32,29 @@ class I80Car(Car):
     max_a = 40
     max_b = 0.01
 
-    def __init__(self, df, y_offset, look_ahead, screen_w, font=None, kernel=0, dt=1/10):
-        k = kernel  # running window size
-        self._length = df.at[df.index[0], 'Vehicle Length'] * FOOT * SCALE
-        self._width = df.at[df.index[0], 'Vehicle Width'] * FOOT * SCALE
-        self.id = df.at[df.index[0], 'Vehicle ID']  # extract scalar <'Vehicle ID'> <at> <index[0]>
+    def __init__(self, df, y_offset, look_ahead, screen_w, font=None, kernel=0, dt=1/10, replay=None):
+        """
+        :param df: trajectory of the car, from its first frame on (unused if replay is given)
+        :param replay: (ReplayKinematics holding the vehicle, first row of the car), to skip smoothing df
+        """
+        if replay is None:
+            replay = ReplayKinematics.build(TrajectoryIndex(df), df, kernel, dt, self.X_OFFSET, y_offset), 0
+        table, row = replay
+        s = int(dt * 10)  # rows per step
+        steps = slice(row, row + (table.end[row] - row) // s * s, s)
+        self._length = table.length[row] * FOOT * SCALE
+        self._width = table.width[row] * FOOT * SCALE
+        self.id = table.vehicle[row]
 
         # X and Y are swapped in the I-80 data set...
-        x = df['Local Y'].rolling(window=k).mean().shift(1 - k).values * FOOT * SCALE - self.X_OFFSET - self._length
-        y = df['Local X'].rolling(window=k).mean().shift(1 - k).values * FOOT * SCALE + y_offset
-        if dt > 1 / 10:
-            s = int(dt * 10)
-            end = len(x) - len(x) % s
-            x = x[:end].reshape(-1, s).mean(axis=1)
-            y = y[:end].reshape(-1, s).mean(axis=1)
+        x = table.position[steps, 0]
+        y = table.position[steps, 1]
         self._max_t = len(x) - np.count_nonzero(np.isnan(x)) - 2  # 2 for computing the acceleration
 
         self._trajectory = np.column_stack((x, y))
-        self._position = self._trajectory[0]
-        self._df = df
+        self._speeds, self._directions = table.speed[steps], table.direction[steps]
+        self._moving = table.next_moving[row + 1] - row  # first row, after the first one, in motion
+        self._position = self._trajectory[0].copy()
         self._frame = 0
         self._dt = dt
         # self._direction = np.array((1, 0), np.float)  # assumes horizontal if initially unknown
@@ -57,21 +63,18 @@ class I80Car(Car):
         self._colour = colours['c']
         self._braked = False
         self.off_screen = self._max_t <= 0
-        self._states = list()
-        self._states_image = list()
+        self._states = History()
+        self._states_image = History()
         self._ego_car_image = None
-        self._actions = list()
+        self._actions = History()
         self._passing = False
-        self._actions = list()
-        self._states = list()
         self.states_image = list()
         self.look_ahead = look_ahead
         self.screen_w = screen_w
         self._safe_factor = 1.5  # second, manually matching the data
-        if font is not None:
-            self._text = self.get_text(self.id, font)
+        self._text = self.get_text(self.id, font) if font is not None else None  # no labels when headless
         self.is_controlled = False
-        self._lane_list = df['Lane Identification'].values
+        self._lane_list = table.lane[row:table.end[row]]
         self.collisions_per_frame = 0
 
     @property
@@ -79,24 +82,20 @@ class I80Car(Car):
         return False
 
     def _get(self, what, k):
-        direction_vector = self._trajectory[k + 1] - self._trajectory[k]
-        norm = np.linalg.norm(direction_vector)
         if what == 'direction':
-            if norm < 1e-6: return self._direction  # if static returns previous direction
-            return direction_vector / norm
+            direction = self._directions[k]
+            if np.isnan(direction[0]): return self._direction  # if static returns previous direction
+            return direction
         if what == 'speed':
-            return norm / self._dt
+            return self._speeds[k]
         if what == 'init_direction':  # valid direction can be computed when speed is non-zero
-            t = 1  # check if the car is in motion the next step
-            while self._df.at[self._df.index[t], 'Vehicle Velocity'] < 5 and t < self._max_t: t += 1
-            # t point to the point in time where speed is > 5
-            direction_vector = self._trajectory[t] - self._trajectory[t - 1]
-            norm = np.linalg.norm(direction_vector)
-            # assert norm > 1e-6, f'norm: {norm} -> too small!'
-            if norm < 1e-6:
+            # first point in time where speed is > 5 (checking from the next step on), or the last one
+            t = max(min(self._moving, self._max_t), 1)
+            direction = self._directions[t - 1]
+            if np.isnan(direction[0]):
                 print(f'{self} has undefined direction, assuming horizontal')
-                return np.array((1, 0), dtype=np.float)
-            return direction_vector / norm
+                return np.array((1, 0), dtype=np.float64)
+            return direction.copy()
 
     # This was trajectories replay (to be used as ground truth, without any policy and action generation)
     # def step(self, action):
@@ -168,6 +167,201 @@ class I80Car(Car):
             # print(f'Accident! Check vehicle {self}. Proximity of {self._states_image[-1][2]}.')
 
 
+def sort_by_vehicle(df):
+    """
+    Rows of df sorted by vehicle, then frame, which TrajectoryIndex then indexes without a copy of its columns
+    """
+    return df.iloc[np.lexsort((df['Frame ID'].values, df['Vehicle ID'].values))]
+
+
+class TrajectoryIndex:
+    """
+    Index of the trajectories of a time slot, built once: the rows of every vehicle, and the frames where every vehicle
+    (re)enters the data, so that spawning vehicles does not scan the whole data frame every frame
+    """
+
+    def __init__(self, df):
+        vehicle_id, frame = df['Vehicle ID'].values, df['Frame ID'].values
+        if np.all((vehicle_id[1:] > vehicle_id[:-1]) | (vehicle_id[1:] == vehicle_id[:-1]) & (frame[1:] > frame[:-1])):
+            self.order = None  # rows already sorted by vehicle, then frame (see sort_by_vehicle)
+            self.vehicle, self.frame = vehicle_id, frame
+        else:
+            self.order = np.lexsort((frame, vehicle_id))  # rows sorted by vehicle, then frame
+            self.vehicle, self.frame = vehicle_id[self.order], frame[self.order]
+        vehicle_id = self.vehicle
+        # rows of every vehicle: self.order[start:end]
+        new_vehicle = np.r_[True, vehicle_id[1:] != vehicle_id[:-1]]
+        start = np.flatnonzero(new_vehicle)
+        end = np.r_[start[1:], len(vehicle_id)]
+        self.rows = dict(zip(vehicle_id[start].tolist(), zip(start.tolist(), end.tolist())))
+        # first and last frame of every vehicle, and vehicles sorted by first frame
+        self.first_frame = dict(zip(vehicle_id[start].tolist(), self.frame[start].tolist()))
+        self.last_frame = dict(zip(vehicle_id[start].tolist(), self.frame[end - 1].tolist()))
+        by_first_frame = np.argsort(self.frame[start], kind='stable')
+        self.arrival_frame = self.frame[start][by_first_frame].tolist()
+        self.arrival_vehicle = vehicle_id[start][by_first_frame].tolist()
+        self.min_frame, self.max_frame = int(self.frame.min()), int(self.frame.max())
+        # runs of consecutive frames of every vehicle, sorted by first frame
+        first = np.flatnonzero(new_vehicle | np.r_[True, self.frame[1:] != self.frame[:-1] + 1])
+        last = np.r_[first[1:], len(vehicle_id)] - 1
+        by_first_frame = np.argsort(self.frame[first], kind='stable')
+        self.run_first = self.frame[first][by_first_frame]
+        self.run_last = self.frame[last][by_first_frame]
+        self.run_vehicle = vehicle_id[first][by_first_frame]
+
+    def arrivals(self, frame, previous_frame=None):
+        """
+        Vehicles in the data at frame, which were not at previous_frame (every vehicle at frame, if None)
+        """
+        if previous_frame is None:
+            runs = np.flatnonzero((self.run_first <= frame) & (self.run_last >= frame))
+        else:
+            start, end = np.searchsorted(self.run_first, (previous_frame, frame), side='right')
+            runs = start + np.flatnonzero(self.run_last[start:end] >= frame)
+        return self.run_vehicle[runs]
+
+    def last_arrival(self, excluded=()):
+        """
+        Last frame when a vehicle, not in excluded, enters the data for the first time
+        """
+        for frame, vehicle_id in zip(reversed(self.arrival_frame), reversed(self.arrival_vehicle)):
+            if vehicle_id not in excluded: return frame
+        raise ValueError('every vehicle is excluded')
+
+    def first_row(self, vehicle_id, frame):
+        """
+        Sorted rows of vehicle_id from frame on, as (first row, end row)
+        """
+        start, end = self.rows[vehicle_id]
+        return start + int(np.searchsorted(self.frame[start:end], frame)), end
+
+    def vehicle_rows(self, df, vehicle_id, frame):
+        """
+        Same as df[(df['Vehicle ID'] == vehicle_id) & (df['Frame ID'] >= frame)], sorted by frame
+        """
+        start, end = self.first_row(vehicle_id, frame)
+        return df.iloc[start:end] if self.order is None else df.iloc[self.order[start:end]]
+
+    def sorted(self, values):
+        """
+        Values of a column of df, sorted by vehicle and frame
+        """
+        return values if self.order is None else values[self.order]
+
+    def checksum(self):
+        """
+        Digest of the (vehicle, frame) rows, which identifies the data tables built on this index were made for
+        """
+        return hashlib.sha1(self.vehicle.tobytes() + self.frame.tobytes()).hexdigest()
+
+
+class ReplayKinematics:
+    """
+    What cars replay from the trajectories of a time slot, for every row (sorted as in its TrajectoryIndex) at once:
+    smoothed position, speed and direction of the steps of a car spawned at the first row of its vehicle, next row in
+    motion, lane and size.
+
+    A car spawned at the first row r of its vehicle is at position[r + t * s] at its t-th step (s = 10 dt rows per
+    step). Positions are smoothed with the same running means as a car smoothing its own trajectory, which depend on the
+    row the running sums start from, so cars spawned at any other row (e.g. already on screen when an episode starts)
+    get tables of their own (see I80._get_spawn_replays). Hence they are computed once per time slot, rather than for
+    every spawned car, in one pass over the rows of every vehicle.
+    """
+    FIELDS = 'vehicle', 'end', 'position', 'speed', 'direction', 'next_moving', 'lane', 'length', 'width'
+
+    def __init__(self, tables):
+        for name in self.FIELDS: setattr(self, name, tables[name])
+
+    @classmethod
+    def build(cls, index, df, kernel, dt, x_offset, y_offset):
+        """
+        :param index: TrajectoryIndex of df
+        :param kernel: smoothing window, in rows
+        :param dt: time step, multiple of 0.1 s
+        :param x_offset: horizontal offset of the cars (X_OFFSET)
+        :param y_offset: vertical offset of the lanes
+        """
+        column = lambda name: index.sorted(df[name].values)
+        s, n = int(dt * 10), len(index.vehicle)
+        start = np.flatnonzero(np.r_[True, index.vehicle[1:] != index.vehicle[:-1]])
+        n_rows = np.diff(np.r_[start, n])
+        first = np.repeat(start, n_rows)  # first row of the vehicle of every row
+        end = np.repeat(np.r_[start[1:], n], n_rows)  # end row of the vehicle of every row
+
+        def smoothed(values):
+            # running mean of the kernel rows from every row on, NaN past the end of its vehicle; a grouped rolling
+            # restarts its running sums at every vehicle, hence it is bit for bit the rolling mean of every vehicle
+            mean = pd.Series(values).groupby(index.vehicle, sort=False).rolling(window=kernel).mean().values
+            ahead = np.arange(n) + kernel - 1
+            ahead[ahead >= end] = n
+            return np.r_[mean, np.nan][ahead]
+
+        # X and Y are swapped in the I-80 data set...
+        length = column('Vehicle Length')
+        x = smoothed(column('Local Y')) * FOOT * SCALE - x_offset - length[first] * FOOT * SCALE
+        y = smoothed(column('Local X')) * FOOT * SCALE + y_offset
+        # first row of every step of a car spawned at the first row of its vehicle
+        n_steps = n_rows // s
+        t = np.arange(n_steps.sum()) - np.repeat(np.cumsum(n_steps) - n_steps, n_steps)  # step of its vehicle
+        steps = np.repeat(start, n_steps) + s * t
+        if dt > 1 / 10:
+            window = steps[:, None] + np.arange(s)  # the step means, as reshape(-1, s).mean(axis=1) of every vehicle
+            x, y = x[window].mean(axis=1), y[window].mean(axis=1)
+        else:
+            x, y = x[steps], y[steps]
+
+        position, speed, direction = np.full((n, 2), np.nan), np.full(n, np.nan), np.full((n, 2), np.nan)
+        position[steps] = np.column_stack((x, y))
+        has_next = index.vehicle[steps[1:]] == index.vehicle[steps[:-1]]
+        step_from, step = steps[:-1][has_next], (position[steps[1:]] - position[steps[:-1]])[has_next]
+        norm = np.linalg.norm(step, axis=1)
+        speed[step_from] = norm / dt
+        with np.errstate(invalid='ignore'):
+            moving = ~(norm < 1e-6)  # static steps have no direction
+        direction[step_from[moving]] = step[moving] / norm[moving, None]
+
+        # rows in motion point to themselves, the others to the next one in motion, or to the end of the vehicle
+        in_motion = np.where(column('Vehicle Velocity') >= 5, np.arange(n), end)
+        next_moving = np.minimum.accumulate(in_motion[::-1])[::-1]
+
+        return cls(dict(
+            vehicle=index.vehicle, end=end, position=position, speed=speed, direction=direction,
+            next_moving=next_moving, lane=column('Lane Identification'), length=length, width=column('Vehicle Width'),
+        ))
+
+    @staticmethod
+    def _read_meta(path):
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, path, index, df, kernel, dt, x_offset, y_offset):
+        """
+        Open the tables saved in path memory-mapped read-only, or build and save them, if missing or made for other
+        data (an unwritable path just keeps them in memory)
+        """
+        meta = dict(checksum=index.checksum(), kernel=kernel, dt=dt, x_offset=x_offset, y_offset=y_offset)
+        opened = lambda: cls({name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in cls.FIELDS})
+        if cls._read_meta(path) == meta: return opened()
+        print(f'Building replay kinematics in {path}')
+        replay = cls.build(index, df, kernel, dt, x_offset, y_offset)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            for name in cls.FIELDS: np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(replay, name))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            trajectories.publish(tmp_path, path, lambda: cls._read_meta(path) == meta)
+        except OSError as error:
+            print(f'Replay kinematics not saved ({error})')
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return replay
+        return opened() if cls._read_meta(path) == meta else replay
+
+
 class I80(Simulator):
     # Environment's car class
     EnvCar = I80Car
@@ -233,6 +427,11 @@ class I80(Simulator):
         pth = 'traffic-data/state-action-cost/data_i80_v0/data_stats.pth'
         self.data_stats = torch.load(pth) if self.normalise_state or self.normalise_action else None
         self.cached_data_frames = dict()
+        self.cached_trajectory_indices = dict()
+        self.trajectories = None  # TrajectoryIndex of the time slot
+        self.cached_replays = dict()
+        self.replay = None  # ReplayKinematics of the time slot
+        self._spawn_frame = None  # last frame when vehicles were spawned
         self.episode = 0
         self.train_indx = None
         self.indx_order = None
@@ -240,50 +439,52 @@ class I80(Simulator):
     def _get_data_frame(self, time_slot, x_max, x_offset):
         if time_slot in self.cached_data_frames:
             return self.cached_data_frames[time_slot]
-        file_name = f'traffic-data/xy-trajectories/{time_slot}'
-        if isfile(file_name + '.pkl'):
-            file_name += '.pkl'
-            print(f'Loading trajectories from {file_name}')
-            df = pd.read_pickle(file_name)
-        elif isfile(file_name + '.txt'):
-            file_name += '.txt'
-            print(f'Loading trajectories from {file_name}')
-            df = pd.read_csv(file_name, sep=r'\s+', header=None, names=(
-                'Vehicle ID',
-                'Frame ID',
-                'Total Frames',
-                'Global Time',
-                'Local X',
-                'Local Y',
-                'Global X',
-                'Global Y',
-                'Vehicle Length',
-                'Vehicle Width',
-                'Vehicle Class',
-                'Vehicle Velocity',
-                'Vehicle Acceleration',
-                'Lane Identification',
-                'Preceding Vehicle',
-                'Following Vehicle',
-                'Spacing',
-                'Headway'
-            ))
-        else:
-            raise FileNotFoundError(f'{file_name}.{{pkl,txt}} not found.')
-
-        # Get valid x coordinate rows
-        valid_x = (df['Local Y'] * FOOT * SCALE - x_offset).between(0, x_max)
-
-        # Cache data frame for later retrieval
-        self.cached_data_frames[time_slot] = df[valid_x]
 
-        # Restrict data frame to valid x coordinates
-        return df[valid_x]
+        def on_screen(df):
+            # Get valid x coordinate rows
+            valid_x = (df['Local Y'] * FOOT * SCALE - x_offset).between(0, x_max)
+            # Restrict data frame to valid x coordinates
+            return sort_by_vehicle(df[valid_x])
+
+        # Cache data frame for later retrieval, shared read-only by the environments of every process
+        self.cached_data_frames[time_slot] = trajectories.shared_frame(
+            time_slot, f'on-screen-{x_offset}-{x_max}', on_screen)
+        return self.cached_data_frames[time_slot]
+
+    def _get_replay(self, time_slot):
+        if time_slot not in self.cached_replays:
+            s, x_offset = int(self.delta_t * 10), self.EnvCar.X_OFFSET
+            name = f'k{self.smoothing_window}-s{s}-x{x_offset}-y{self.offset}'
+            path = f'traffic-data/xy-trajectories/{time_slot}.replay/{name}'
+            self.cached_replays[time_slot] = ReplayKinematics.load(
+                path, self.trajectories, self.df, self.smoothing_window, self.delta_t, x_offset, self.offset)
+        return self.cached_replays[time_slot]
+
+    def _get_spawn_replays(self, vehicles):
+        """
+        (ReplayKinematics, first row) of the vehicles spawned at self.frame, with enough rows left to be smoothed
+        The replay tables only hold cars spawned at the first row of their vehicle: the others (e.g. already on screen
+        when an episode starts) are smoothed here, all in one table, as they would smooth their own trajectory
+        """
+        replays, mid_trajectory = dict(), list()
+        for vehicle_id in sorted(vehicles):
+            row, end = self.trajectories.first_row(vehicle_id, self.frame)
+            if end - row < self.smoothing_window + 1: continue
+            if row == self.trajectories.rows[vehicle_id][0]:
+                replays[vehicle_id] = self.replay, row
+            else:
+                mid_trajectory.append((vehicle_id, row, end))
+        if mid_trajectory:
+            rows = np.concatenate([np.arange(row, end) for _, row, end in mid_trajectory])
+            df = self.df.iloc[self.trajectories.sorted(rows)]
+            index = TrajectoryIndex(df)
+            replay = ReplayKinematics.build(
+                index, df, self.smoothing_window, self.delta_t, self.EnvCar.X_OFFSET, self.offset)
+            for vehicle_id, _, _ in mid_trajectory: replays[vehicle_id] = replay, index.rows[vehicle_id][0]
+        return replays
 
     def _get_first_frame(self, v_id):
-        vehicle_data = self.df[self.df['Vehicle ID'] == v_id]
-        frame = vehicle_data.at[vehicle_data.index[0], 'Frame ID']
-        return frame
+        return self.trajectories.first_frame[v_id]
 
     def reset(self, frame=None, time_slot=None, vehicle_id=None, train_only=False):
 
@@ -310,22 +511,22 @@ class I80(Simulator):
         # print(f'\n > Env on process {os.getpid()} is resetting')
         self._t_slot = self._time_slots[time_slot] if time_slot is not None else self.random.choice(self._time_slots)
         self.df = self._get_data_frame(self._t_slot, self.screen_size[0], self.X_OFFSET)
-        self.max_frame = max(self.df['Frame ID'])
+        if self._t_slot not in self.cached_trajectory_indices:
+            self.cached_trajectory_indices[self._t_slot] = TrajectoryIndex(self.df)
+        self.trajectories = self.cached_trajectory_indices[self._t_slot]
+        self.replay = self._get_replay(self._t_slot)
+        self.max_frame = self.trajectories.max_frame
         if vehicle_id: frame = self._get_first_frame(vehicle_id)
         if frame is None:  # controlled
-            # Start at a random valid (new_vehicles is not empty) initial frame
-            frame_df = self.df['Frame ID'].values
-            new_vehicles = set()
-            while not new_vehicles:
-                frame = self.random.randrange(min(frame_df), max(frame_df))
-                vehicles_history = set(self.df[self.df['Frame ID'] <= frame]['Vehicle ID'])
-                new_vehicles = set(self.df[self.df['Frame ID'] > frame]['Vehicle ID']) - vehicles_history
-                new_vehicles -= self._black_list[self._t_slot]  # clean up fuckers
+            # Start at a random valid initial frame: some (not black listed) vehicle enters the data afterwards
+            last_arrival = self.trajectories.last_arrival(self._black_list[self._t_slot])
+            frame = self.random.randrange(self.trajectories.min_frame, min(self.max_frame, last_arrival))
         if self.controlled_car:
             self.controlled_car['frame'] = frame
             self.controlled_car['v_id'] = vehicle_id
         self.frame = frame - int(self.delta_t * 10)
         self.vehicles_history = set()
+        self._spawn_frame = None
         # # Account for off-track vehicles
         # with open('off_track.pkl', 'rb') as f:
         #     self.off_track = pickle.load(f)
@@ -360,20 +561,20 @@ class I80(Simulator):
             np.multiply(policy_action, self.data_stats['a_std'], policy_action)  # multiply by the std
             np.add(policy_action, self.data_stats['a_mean'], policy_action)  # add the mean
 
-        df = self.df
-        now = df['Frame ID'] == self.frame
-        vehicles = set(df[now]['Vehicle ID']) - self.vehicles_history - self._black_list[self._t_slot]
+        # Vehicles entering the data since the previous step, which were never spawned before
+        arrivals = self.trajectories.arrivals(self.frame, self._spawn_frame)
+        self._spawn_frame = self.frame
+        vehicles = set(arrivals.tolist()) - self.vehicles_history - self._black_list[self._t_slot]
 
         if vehicles:
-            now_and_on = df['Frame ID'] >= self.frame
+            replays = self._get_spawn_replays(vehicles)
             for vehicle_id in vehicles:
-                this_vehicle = df['Vehicle ID'] == vehicle_id
-                car_df = df[this_vehicle & now_and_on]
-                if len(car_df) < self.smoothing_window + 1: continue
+                if vehicle_id not in replays: continue
                 f = self.font[20] if self.display else None
-                car = self.EnvCar(car_df, self.offset, self.look_ahead, self.screen_size[0], f, self.smoothing_window,
-                                  dt=self.delta_t)
-                self.vehicles.append(car)
+                replay = replays[vehicle_id]
+                car = self.EnvCar(None, self.offset, self.look_ahead, self.screen_size[0], f, self.smoothing_window,
+                                  dt=self.delta_t, replay=replay)
+                self._add_vehicle(car)
                 if self.controlled_car and \
                         not self.controlled_car['locked'] and \
                         self.frame >= self.controlled_car['frame'] and \
@@ -381,6 +582,7 @@ class I80(Simulator):
                     self.controlled_car['locked'] = car
                     car.is_controlled = True
                     car.buffer_size = self.nb_states
+                    if not self.store: car.bound_history(self.nb_states)  # only get_last() reads its history
                     car.lanes = self.lanes
                     car.look_ahead = self.look_ahead
                     # print(f'Controlling car {car.id}')
@@ -388,14 +590,14 @@ class I80(Simulator):
                     # print(f'Creating folder {self.dump_folder}')
                     # system(f'mkdir -p screen-dumps/{self.dump_folder}')
                     if self.store_sim_video:
-                        self.ghost = self.EnvCar(car_df, self.offset, self.look_ahead, self.screen_size[0], f,
-                                                 self.smoothing_window, dt=self.delta_t)
+                        self.ghost = self.EnvCar(None, self.offset, self.look_ahead, self.screen_size[0], f,
+                                                 self.smoothing_window, dt=self.delta_t, replay=replay)
             self.vehicles_history |= vehicles  # union set operation
 
-        self.lane_occupancy = [[] for _ in range(7)]
         if self.show_frame_count:
             print(f'\r[t={self.frame}]', end='')
 
+        lanes = list()
         for v in self.vehicles[:]:
             if v.off_screen:
                 # print(f'vehicle {v.id} [off screen]')
@@ -403,12 +605,21 @@ class I80(Simulator):
                     file_name = os.path.join(self.data_dir, self.DUMP_NAME, os.path.basename(self._t_slot))
                     print(f'[dumping {v} in {file_name}]')
                     v.dump_state_image(file_name, 'tensor')
-                self.vehicles.remove(v)
+                self._remove_vehicle(v)
             else:
-                # Insort it in my vehicle list
                 lane_idx = v.current_lane
-                assert v.current_lane < self.nb_lanes, f'{v} is in lane {v.current_lane} at frame {self.frame}'
-                bisect.insort(self.lane_occupancy[lane_idx], v)
+                assert lane_idx < self.nb_lanes, f'{v} is in lane {lane_idx} at frame {self.frame}'
+                lanes.append(lane_idx)
+
+        if self.kinematics is None:
+            # Insort every vehicle in its lane list, vehicles will be moving while their neighbours are looked up
+            neighbours = None
+            self.lane_occupancy = [[] for _ in range(7)]
+            for v, lane_idx in zip(self.vehicles, lanes): bisect.insort(self.lane_occupancy[lane_idx], v)
+        else:
+            # Find everyone's neighbours at once, nobody moves before all the actions are chosen
+            neighbours = NeighbourIndex(self.vehicles, lanes, 7)
+            self.lane_occupancy = neighbours.lane_occupancy()
 
         if self.state_image or self.controlled_car and self.controlled_car['locked']:
             # How much to look far ahead
@@ -416,31 +627,28 @@ class I80(Simulator):
             look_sideways = 2 * self.LANE_W
             self.render(mode='machine', width_height=(2 * look_ahead, 2 * look_sideways), scale=0.25)
 
-        for v in self.vehicles:
+        states, actions = list(), list()
+        for i, v in enumerate(self.vehicles):
 
             # Generate symbolic state
-            lane_idx = v.current_lane
-            left_vehicles = self._get_neighbours(lane_idx, -1, v) \
+            lane_idx = lanes[i]
+            left_vehicles = self._neighbours(neighbours, i, lane_idx, -1) \
                 if 0 < lane_idx < 6 or lane_idx == 6 and v.front[0] > 18 * LANE_W else None
-            mid_vehicles = self._get_neighbours(lane_idx, 0, v)
-            right_vehicles = self._get_neighbours(lane_idx, + 1, v) \
+            mid_vehicles = self._neighbours(neighbours, i, lane_idx, 0)
+            right_vehicles = self._neighbours(neighbours, i, lane_idx, + 1) \
                 if lane_idx < 5 or lane_idx == 5 and v.front[0] > 18 * LANE_W else None
             state = left_vehicles, mid_vehicles, right_vehicles
 
             # Sample an action based on the current state
             action = v.policy() if not v.is_autonomous else policy_action
 
-            # Perform such action
-            v.step(action)
-
-            # Store state and action pair
-            if (self.store or v.is_controlled) and v.valid:
-                v.store('state', state)
-                v.store('action', action)
-
-            if v.is_controlled and v.valid:
-                v.count_collisions(state)
-                if v.collisions_per_frame > 0: self.collision = True
+            if self.kinematics is None:
+                # Perform such action
+                v.step(action)
+                self._store_state_action(v, state, action)
+            else:
+                states.append(state)
+                actions.append(action)
 
             # # Create set of off track vehicles
             # if v._colour[0] > 128:  # one lane away
@@ -456,6 +664,12 @@ class I80(Simulator):
             #         v.collisions_per_frame = 1
             #         self.collision = True
 
+        if self.kinematics is not None:
+            # Perform all actions at once, then store the states, all from the same updated frame
+            self.kinematics.step(self.vehicles, actions)
+            for v, state, action in zip(self.vehicles, states, actions):
+                self._store_state_action(v, state, action)
+
         # if self.frame == self.accident['frame']:
         #     print('Colliding vehicles:', self.accident['cars'])
         #     self.accident = self.get_next_accident()
@@ -483,6 +697,20 @@ class I80(Simulator):
         # return observation, reward, done, info
         return None, None, self.done, None
 
+    def _neighbours(self, neighbours, i, lane_idx, d_lane):
+        if neighbours is None: return self._get_neighbours(lane_idx, d_lane, self.vehicles[i])
+        return neighbours.neighbours(i, d_lane)
+
+    def _store_state_action(self, v, state, action):
+        # Store state and action pair
+        if (self.store or v.is_controlled) and v.valid:
+            v.store('state', state)
+            v.store('action', action)
+
+        if v.is_controlled and v.valid:
+            v.count_collisions(state)
+            if v.collisions_per_frame > 0: self.collision = True
+
     def _draw_lanes(self, surface, mode='human', offset=0):
 
         slope = 0.035
@@ -96,44 +96,6 @@ class Lankershim(I80):
         self.smoothing_window = 15
         self.offset = 195
 
-    @staticmethod
-    def _get_data_frame(time_slot, x_max, x_offset):
-        # TODO: need caching! See I-80
-        file_name = f'traffic-data/xy-trajectories/{time_slot}.txt'
-        print(f'Loading trajectories from {file_name}')
-        df = pd.read_csv(file_name, sep=r'\s+', header=None, names=(
-            'Vehicle ID',
-            'Frame ID',
-            'Total Frames',
-            'Global Time',
-            'Local X',
-            'Local Y',
-            'Global X',
-            'Global Y',
-            'Vehicle Length',
-            'Vehicle Width',
-            'Vehicle Class',
-            'Vehicle Velocity',
-            'Vehicle Acceleration',
-            'Lane Identification',
-            'Origin Zone',
-            'Destination Zone',
-            'Intersection',
-            'Section',
-            'Direction',
-            'Movement',
-            'Preceding Vehicle',
-            'Following Vehicle',
-            'Spacing',
-            'Headway'
-        ))
-
-        # Get valid x coordinate rows
-        valid_x = (df['Local Y'] * FOOT * SCALE - x_offset).between(0, x_max).values
-
-        # Restrict data frame to valid x coordinates
-        return df[valid_x]
-
     def _draw_lanes(self, surface, mode='human', offset=0):
 
         if mode == 'human':
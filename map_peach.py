@@ -2,8 +2,9 @@ from random import choice, randrange
 
 from custom_graphics import draw_dashed_line
 from map_lanker import LankerCar
-from map_i80 import I80, colours
+from map_i80 import I80, colours, sort_by_vehicle
 from traffic_gym import Simulator
+import trajectories
 import pygame
 import pandas as pd
 import numpy as np
@@ -103,53 +104,33 @@ class Peachtree(I80):
         self.offset = -180 if time_slot == 0 else -15
 
     def _get_data_frame(self, time_slot, x_max, x_offset):
-        # TODO: should use Lanker, not re-implement this!
-        file_name = f'traffic-data/xy-trajectories/{time_slot}.txt'
-        print(f'Loading trajectories from {file_name}')
-        df = pd.read_csv(file_name, sep=r'\s+', header=None, names=(
-            'Vehicle ID',
-            'Frame ID',
-            'Total Frames',
-            'Global Time',
-            'Local X',
-            'Local Y',
-            'Global X',
-            'Global Y',
-            'Vehicle Length',
-            'Vehicle Width',
-            'Vehicle Class',
-            'Vehicle Velocity',
-            'Vehicle Acceleration',
-            'Lane Identification',
-            'Origin Zone',
-            'Destination Zone',
-            'Intersection',
-            'Section',
-            'Direction',
-            'Movement',
-            'Preceding Vehicle',
-            'Following Vehicle',
-            'Spacing',
-            'Headway'
-        ))
-
-        # Get valid x coordinate rows
-        valid_x = (df['Local Y'] * FOOT * SCALE - x_offset).between(0, x_max).values
-        df = df[valid_x]
-
-        # Invert coordinates (IDK WTF is going on with these trajectories)
-        max_x = df['Local Y'].max()
-        max_y = df['Local X'].max()
-        extra_offset = 30 if time_slot == 0 else 17
-        df['Local Y'] = max_x + extra_offset - df['Local Y']
-        df['Local X'] = max_y - df['Local X']
+        if time_slot in self.cached_data_frames:
+            return self.cached_data_frames[time_slot]
+
+        def on_screen(df):
+            # Get valid x coordinate rows
+            valid_x = (df['Local Y'] * FOOT * SCALE - x_offset).between(0, x_max).values
+            df = df[valid_x]
+
+            # Invert coordinates (IDK WTF is going on with these trajectories)
+            max_x = df['Local Y'].max()
+            max_y = df['Local X'].max()
+            extra_offset = 30 if time_slot == 0 else 17
+            df['Local Y'] = max_x + extra_offset - df['Local Y']
+            df['Local X'] = max_y - df['Local X']
+
+            return sort_by_vehicle(df)
+
+        # Shared read-only by the environments of every process
+        df = trajectories.shared_frame(time_slot, f'peach-on-screen-{x_offset}-{x_max}', on_screen)
 
         # Dropping cars with lifespan shorter than 5 second
         baby_cars = set(df[df['Total Frames'] < 50]['Vehicle ID'])
         print(f'Removing {len(baby_cars)} baby vehicles from the database')
         self._black_list[time_slot] |= baby_cars
 
-        # Restrict data frame to valid x coordinates
+        # Cache data frame for later retrieval
+        self.cached_data_frames[time_slot] = df
         return df
 
     def _draw_lanes(self, surface, mode='human', offset=0):
@@ -271,7 +271,7 @@ def train_policy_net_mpur(model, inputs, targets, car_sizes, n_models=10, sampli
     target_images, target_states, target_costs = targets
     ego_car_new_shape = [*input_images_orig.shape]
     ego_car_new_shape[2] = 1
-    input_ego_car = input_ego_car_orig[:, 2][:, None, None].expand(ego_car_new_shape)
+    input_ego_car = input_ego_car_orig[:, None, None].expand(ego_car_new_shape)
 
     input_images = torch.cat((input_images_orig, input_ego_car), dim=2)
     input_states = input_states_orig.clone()
@@ -374,8 +374,10 @@ def train_policy_net_mpur(model, inputs, targets, car_sizes, n_models=10, sampli
     loss_a = pred_actions.norm(2, 2).pow(2).mean()
 
     pred_images = pred_images[:, :, :3]
+    # draw the ego car in the blue channel
+    state_img = torch.cat((pred_images[:, :, :2], pred_images[:, :, 2:] + input_ego_car_orig[:, None, None]), 2)
     predictions = dict(
-        state_img=(pred_images + input_ego_car_orig[:, None].expand_as(pred_images)).clamp(max=1.),
+        state_img=state_img.clamp(max=1.),
         state_vct=pred_states,
         proximity=proximity_loss,
         lane=lane_loss,
@@ -11,6 +11,8 @@ parser.add_argument('-store', type=int, default=0)
 parser.add_argument('-nb_episodes', type=int, default=1)
 parser.add_argument('-fps', type=int, default=1e3)
 parser.add_argument('-delta_t', type=float, default=0.1)
+parser.add_argument('-vectorised', type=int, default=0, help='integrate all vehicles at once')
+parser.add_argument('-batched_views', type=int, default=0, help='extract all state images at once')
 
 opt = parser.parse_args()
 
@@ -21,6 +23,8 @@ kwargs = {
     'state_image': opt.state_image,
     'store': opt.store,
     'delta_t': opt.delta_t,
+    'vectorised': opt.vectorised,
+    'batched_views': opt.batched_views,
 }
 
 gym.envs.registration.register(
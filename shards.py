@@ -0,0 +1,370 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+
+import numpy
+import torch
+
+# On-disk layout of a converted data shard (one time slot of a data set):
+#
+# <data_dir>/<time_slot>/mmap/
+# ├── meta.json    # fields dtype and per-row shape, number of rows, episode ids and index, converted source files
+# ├── index.npy    # (n_episodes, 2) int64: [offset, length] of each episode, in rows
+# ├── images.bin   # (n_rows, 3, 117, 24) uint8
+# ├── states.bin   # (n_rows, 7, 4) float32, ego-car + 6 neighbours
+# ├── actions.bin  # (n_rows, 2) float32
+# ├── costs.bin    # (n_rows, 2) float32, [pixel proximity cost, lane cost]
+# ├── ego_car_index.bin  # (n_episodes,) int32, row of the episode ego car in ego_car_masks
+# └── ego_car_masks.bin  # (n_masks, 117, 24) uint8, distinct ego car masks (blue channel of the dumped ego_car)
+#
+# All episodes of a shard are concatenated along the first (time) dimension, so a window of T frames of episode e
+# is field[offset[e] + t : offset[e] + t + T], and rows of different fields with the same index are aligned.
+# The ego car mask depends on the car size only, so it is stored once per distinct mask rather than per episode.
+
+MMAP_DIR = 'mmap'
+FRAME_FIELDS = {  # fields with one row per frame
+    'images': 'uint8',
+    'states': 'float32',
+    'actions': 'float32',
+    'costs': 'float32',
+}
+EPISODE_FIELDS = {  # fields with one row per episode
+    'ego_car_index': 'int32',
+}
+TABLE_FIELDS = {  # tables of distinct rows, referenced by episode fields
+    'ego_car_masks': 'uint8',
+}
+FIELDS = {**FRAME_FIELDS, **EPISODE_FIELDS, **TABLE_FIELDS}
+
+
+def _numpy(x, dtype):
+    if isinstance(x, torch.Tensor): x = x.numpy()
+    return numpy.asarray(x, dtype=dtype)
+
+
+def episode_from_pickle(file_name):
+    """
+    Read a car{idx}.pkl file, as dumped by Car.dump_state_image, into a dict of arrays
+    :param file_name: path of the pickled episode
+    :return: dict with images, states, actions, costs and ego_car (blue channel only)
+    """
+    with open(file_name, 'rb') as f:
+        fd = pickle.load(f)
+    Ta = fd['actions'].size(0)
+    return dict(
+        images=fd['images'],
+        states=fd['states'],
+        actions=fd['actions'],
+        costs=torch.cat((
+            fd.get('pixel_proximity_cost')[:Ta].view(-1, 1),
+            fd.get('lane_cost')[:Ta].view(-1, 1),
+        ), 1),
+        ego_car=fd['ego_car'][2],
+    )
+
+
+class ShardWriter:
+    """
+    Write episodes into a memory-mapped shard, possibly resuming or updating an existing one
+
+    Frame rows are only ever appended, and the shard is made consistent by checkpoint(), which atomically rewrites
+    meta.json, the single source of truth: whatever was written after the last checkpoint is truncated away when the
+    shard is opened again for writing. A shard is flagged as complete only by close(), so that readers never open a
+    half written shard, and an interrupted build is picked up where it was left.
+    """
+
+    def __init__(self, shard_dir, resume=False):
+        self.path = os.path.join(shard_dir, MMAP_DIR)
+        meta = _read_meta(self.path, upgrade=True) if resume else None
+        if meta is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            meta = dict(n_rows=0, fields=dict(), ids=[], index=[], sources=dict(), table_rows=dict())
+        self.n_rows = meta['n_rows']
+        self.table_rows = meta['table_rows']
+        self.ids = meta['ids']
+        # the shape of a field is only known once a row of it is written (earlier versions saved () for the others)
+        self.shapes = {f: tuple(info['shape']) for f, info in meta['fields'].items() if self._n_rows(f) > 0}
+        # shards converted before the index was stored in meta.json only have index.npy
+        if 'index' not in meta:
+            meta['index'] = numpy.load(os.path.join(self.path, 'index.npy')).tolist()
+        self.index = meta['index']
+        self.sources = meta.get('sources', dict())  # id -> [size, mtime_ns] of the file it was converted from
+        self.position = {id_: e for e, id_ in enumerate(self.ids)}
+        self.files = dict()
+        for f in FIELDS:
+            file_name = os.path.join(self.path, f'{f}.bin')
+            self.files[f] = open(file_name, 'r+b' if os.path.isfile(file_name) else 'w+b')
+            self.files[f].truncate(self._row_bytes(f) * self._n_rows(f))
+        # row of every distinct ego car mask already in the table
+        self.files['ego_car_masks'].seek(0)
+        masks = self.files['ego_car_masks'].read()
+        size = self._row_bytes('ego_car_masks')
+        self.ego_car_masks = {masks[r * size:(r + 1) * size]: r for r in range(self._n_rows('ego_car_masks'))}
+        self.checkpoint()  # flag the shard as incomplete until close()
+
+    def _n_rows(self, field):
+        if field in FRAME_FIELDS: return self.n_rows
+        if field in EPISODE_FIELDS: return len(self.ids)
+        return self.table_rows.get(field, 0)
+
+    def _row_bytes(self, field):
+        if field not in self.shapes: return 0
+        return numpy.dtype(FIELDS[field]).itemsize * int(numpy.prod(self.shapes[field]))
+
+    def _write(self, field, array, row):
+        array = _numpy(array, FIELDS[field])
+        shape = array.shape[1:] if field in FRAME_FIELDS else array.shape
+        assert self.shapes.setdefault(field, shape) == shape, f'{field} shape {shape} != {self.shapes[field]}'
+        self.files[field].seek(row * self._row_bytes(field))
+        self.files[field].write(array.tobytes())
+
+    def append(self, id_, episode, source=None):
+        """
+        Append an episode, or replace it if id_ is already in the shard
+        :param id_: episode id
+        :param episode: dict of arrays, as returned by episode_from_pickle
+        :param source: optional [size, mtime_ns] of the source file, used to skip it when it is converted again
+        """
+        # Frames in excess (images and states can be longer than actions, or vice versa) cannot be part of a valid
+        # training window anyway, so trim every frame field to the shortest one
+        length = min(len(episode[f]) for f in FRAME_FIELDS)
+        for f in FRAME_FIELDS:
+            self._write(f, episode[f][:length], self.n_rows)
+        # A replaced episode keeps its position, so that data splits stay valid; its old frames are left unreferenced
+        e = self.position.setdefault(id_, len(self.ids))
+        mask = _numpy(episode['ego_car'], TABLE_FIELDS['ego_car_masks'])
+        r = self.ego_car_masks.get(mask.tobytes())
+        if r is None:
+            r = self.ego_car_masks[mask.tobytes()] = self._n_rows('ego_car_masks')
+            self._write('ego_car_masks', mask, r)
+            self.table_rows['ego_car_masks'] = r + 1
+        self._write('ego_car_index', r, e)
+        if e == len(self.ids):
+            self.ids.append(id_)
+            self.index.append([self.n_rows, length])
+        else:
+            self.index[e] = [self.n_rows, length]
+        if source is not None:
+            self.sources[id_] = source
+        self.n_rows += length
+
+    def checkpoint(self, complete=False):
+        for f in self.files.values(): f.flush()
+        index = numpy.array(self.index, dtype=numpy.int64).reshape(-1, 2)
+        numpy.save(os.path.join(self.path, 'index.npy'), index)
+        meta = dict(
+            n_rows=self.n_rows,
+            fields={f: dict(dtype=FIELDS[f], shape=shape) for f, shape in self.shapes.items()},
+            ids=self.ids,
+            index=self.index,
+            sources=self.sources,
+            table_rows=self.table_rows,
+            complete=complete,
+        )
+        _write_meta(self.path, meta)
+
+    @property
+    def unreferenced_rows(self):
+        return self.n_rows - sum(length for _, length in self.index)
+
+    def close(self):
+        self.checkpoint(complete=True)
+        for f in self.files.values(): f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.checkpoint()
+            for f in self.files.values(): f.close()
+
+
+def _read_meta(path, upgrade=False):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if upgrade and 'ego_car' in meta['fields']:
+        meta = _upgrade_ego_car(path, meta)
+    return meta
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+def _upgrade_ego_car(path, meta):
+    """
+    Replace the full ego car image of every episode (ego_car.bin) of a shard with the ego car masks table
+    """
+    print(f'[deduplicating ego car masks of {path}]')
+    n_episodes = len(meta['ids'])
+    info = meta['fields']['ego_car']
+    masks, index = numpy.empty((0,)), numpy.empty((0,))
+    if n_episodes > 0:
+        ego_car = numpy.fromfile(os.path.join(path, 'ego_car.bin'), dtype=info['dtype'])
+        ego_car = ego_car[:n_episodes * int(numpy.prod(info['shape']))].reshape(n_episodes, *info['shape'])
+        masks, index = numpy.unique(ego_car[:, 2], axis=0, return_inverse=True)
+    # new files first, meta.json last: an interrupted upgrade is just done again
+    _numpy(masks, TABLE_FIELDS['ego_car_masks']).tofile(os.path.join(path, 'ego_car_masks.bin'))
+    _numpy(index, EPISODE_FIELDS['ego_car_index']).tofile(os.path.join(path, 'ego_car_index.bin'))
+    del meta['fields']['ego_car']
+    meta['fields']['ego_car_index'] = dict(dtype=EPISODE_FIELDS['ego_car_index'], shape=[])
+    meta['fields']['ego_car_masks'] = dict(dtype=TABLE_FIELDS['ego_car_masks'], shape=list(masks.shape[1:]))
+    meta['table_rows'] = dict(ego_car_masks=len(masks))
+    _write_meta(path, meta)
+    os.remove(os.path.join(path, 'ego_car.bin'))
+    return meta
+
+
+class ShardStore:
+    """
+    Read-only view of a memory-mapped shard
+
+    Opening a shard reads only meta.json and index.npy, the fields are mapped and paged in on demand by the OS, which
+    shares the pages among all processes reading the same shard.
+    """
+
+    def __init__(self, shard_dir):
+        self.path = os.path.join(shard_dir, MMAP_DIR)
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.ids = meta['ids']
+        self.n_episodes = len(self.ids)
+        self.n_rows = meta['n_rows']
+        self.index = numpy.load(os.path.join(self.path, 'index.npy'))
+        table_rows = meta.get('table_rows', dict())
+        for field, info in meta['fields'].items():
+            n = table_rows.get(field, self.n_rows if field in FRAME_FIELDS else self.n_episodes)
+            shape = (n, *info['shape'])
+            if n == 0:  # cannot mmap an empty file
+                array = numpy.empty(shape, dtype=info['dtype'])
+            else:
+                array = numpy.memmap(os.path.join(self.path, f'{field}.bin'), dtype=info['dtype'], mode='r', shape=shape)
+            setattr(self, field, array)
+
+    @staticmethod
+    def exists(shard_dir):
+        meta = _read_meta(os.path.join(shard_dir, MMAP_DIR))
+        return meta is not None and meta.get('complete', True)
+
+
+def convert_pth(shard_dir):
+    """
+    Convert a legacy <shard_dir>/all_data.pth into a memory-mapped shard
+    """
+    combined_data_path = os.path.join(shard_dir, 'all_data.pth')
+    print(f'[converting {combined_data_path}]')
+    data = torch.load(combined_data_path)
+    with ShardWriter(shard_dir) as writer:
+        for e, id_ in enumerate(data['ids']):
+            writer.append(id_, dict(
+                images=data['images'][e],
+                states=data['states'][e],
+                actions=data['actions'][e],
+                costs=data['costs'][e],
+                ego_car=data['ego_car'][e][2],
+            ))
+
+
+def _source_stamp(file_name):
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _load_pickle(file_name):
+    # runs in the pool workers: numpy arrays are sent back to the writer process much faster than tensors
+    return {k: v.numpy() for k, v in episode_from_pickle(file_name).items()}
+
+
+def default_workers():
+    return len(os.sched_getaffinity(0))
+
+
+def build_from_pickles(shard_dir, workers=1, resume=True, checkpoint_every=100):
+    """
+    Build or update a memory-mapped shard from the <shard_dir>/car*.pkl episodes
+
+    Only files that are new or changed (size or modification time) since they were last converted are read, in
+    parallel, and appended to the shard, so an interrupted build is resumed and a rerun after adding episodes is fast.
+    :param shard_dir: time slot directory
+    :param workers: number of processes reading the pickles
+    :param resume: if False, the shard is rebuilt from scratch
+    :param checkpoint_every: number of episodes appended between checkpoints
+    """
+    file_names = sorted(glob.glob(f'{shard_dir}/car*.pkl'))
+    with ShardWriter(shard_dir, resume=resume) as writer:
+        # episodes are matched by file name, so that the data set directory can be given as any equivalent path
+        converted = {os.path.basename(id_): id_ for id_ in writer.ids}
+        ids = [converted.get(os.path.basename(f), f) for f in file_names]
+        stamps = [_source_stamp(f) for f in file_names]
+        todo = [(f, id_, s) for f, id_, s in zip(file_names, ids, stamps) if writer.sources.get(id_) != s]
+        print(f'[{shard_dir}: {len(file_names) - len(todo)} episodes up to date, {len(todo)} to convert]')
+        missing = set(writer.ids) - set(ids)
+        if missing:
+            print(f'[{shard_dir}: {len(missing)} episodes have no car*.pkl any more, use -force to drop them]')
+        pool = multiprocessing.Pool(workers) if workers > 1 and len(todo) > 1 else None
+        try:
+            # imap returns episodes in order, so that a build from scratch is deterministic
+            file_names = [f for f, _, _ in todo]
+            episodes = pool.imap(_load_pickle, file_names, chunksize=4) if pool else map(_load_pickle, file_names)
+            for n, ((_, id_, stamp), episode) in enumerate(zip(todo, episodes), 1):
+                writer.append(id_, episode, source=stamp)
+                if n % checkpoint_every == 0:
+                    writer.checkpoint()
+                    print(f'[{shard_dir}: {n}/{len(todo)} episodes converted]')
+        finally:
+            if pool: pool.terminate()
+        if writer.unreferenced_rows:
+            print(f'[{shard_dir}: {writer.unreferenced_rows} frames of replaced episodes, use -force to drop them]')
+
+
+def open_shard(shard_dir):
+    """
+    Open a memory-mapped shard, converting all_data.pth or car*.pkl files on first use
+    """
+    if not ShardStore.exists(shard_dir):
+        if os.path.isfile(os.path.join(shard_dir, 'all_data.pth')):
+            convert_pth(shard_dir)
+        else:
+            build_from_pickles(shard_dir, workers=default_workers())
+    _read_meta(os.path.join(shard_dir, MMAP_DIR), upgrade=True)
+    print(f'[loading data shard: {os.path.join(shard_dir, MMAP_DIR)}]')
+    return ShardStore(shard_dir)
+
+
+def data_set_dir(dataset):
+    if dataset == 'i80' or dataset == 'us101':
+        return f'traffic-data/state-action-cost/data_{dataset}_v0'
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataset', type=str, default='i80', help='i80, us101, or path to a data set directory')
+    parser.add_argument('-workers', type=int, default=default_workers(), help='processes reading car*.pkl files')
+    parser.add_argument('-force', action='store_true', help='rebuild shards from scratch')
+    opt = parser.parse_args()
+
+    data_dir = data_set_dir(opt.dataset)
+    for shard in next(os.walk(data_dir))[1]:
+        shard_dir = os.path.join(data_dir, shard)
+        if os.path.isfile(os.path.join(shard_dir, 'all_data.pth')):
+            # legacy shards have no car*.pkl to update from
+            if ShardStore.exists(shard_dir) and not opt.force:
+                print(f'[{shard_dir} already converted]')
+            else:
+                convert_pth(shard_dir)
+        else:
+            build_from_pickles(shard_dir, workers=opt.workers, resume=not opt.force)
@@ -0,0 +1,84 @@
+import numpy
+import pandas as pd
+import pytest
+
+from map_i80 import FOOT, SCALE, X_OFFSET, I80Car, ReplayKinematics, TrajectoryIndex, sort_by_vehicle
+
+KERNEL = 15
+Y_OFFSET = 36
+
+
+def _time_slot(n_vehicles=12, seed=0):
+    rng = numpy.random.RandomState(seed)
+    rows = []
+    for v in range(1, n_vehicles + 1):
+        first, n = rng.randint(0, 100), rng.randint(20, 200)
+        speed = numpy.abs(30 + rng.randn(n).cumsum())
+        speed[:rng.randint(0, 10)] = 0  # some vehicles start static
+        rows.append(pd.DataFrame({
+            'Vehicle ID': v,
+            'Frame ID': first + numpy.arange(n),
+            'Local X': numpy.round(12 + rng.randn(n).cumsum() * 0.1, 3),
+            'Local Y': numpy.round(100 * rng.rand() + (speed * 0.1).cumsum(), 3),
+            'Vehicle Length': numpy.round(14 + 4 * rng.rand(), 1),
+            'Vehicle Width': numpy.round(5 + 2 * rng.rand(), 1),
+            'Vehicle Velocity': speed,
+            'Lane Identification': rng.randint(1, 7),
+        }))
+    # rows of the text files are sorted by frame in the on-screen data frames of earlier versions
+    return sort_by_vehicle(pd.concat(rows).sort_values('Frame ID', kind='stable').reset_index(drop=True))
+
+
+def _smoothed_trajectory(df, dt):
+    # I80Car.__init__ before the replay tables: the reference arithmetic, one car at a time
+    k = KERNEL
+    length = df.at[df.index[0], 'Vehicle Length'] * FOOT * SCALE
+    x = df['Local Y'].rolling(window=k).mean().shift(1 - k).values * FOOT * SCALE - X_OFFSET - length
+    y = df['Local X'].rolling(window=k).mean().shift(1 - k).values * FOOT * SCALE + Y_OFFSET
+    if dt > 1 / 10:
+        s = int(dt * 10)
+        end = len(x) - len(x) % s
+        x = x[:end].reshape(-1, s).mean(axis=1)
+        y = y[:end].reshape(-1, s).mean(axis=1)
+    trajectory = numpy.column_stack((x, y))
+    max_t = len(x) - numpy.count_nonzero(numpy.isnan(x)) - 2
+    speeds = [numpy.linalg.norm(trajectory[t + 1] - trajectory[t]) / dt for t in range(max_t + 1)]
+    return trajectory, max_t, speeds
+
+
+def _car(df, dt, replay=None):
+    return I80Car(df, Y_OFFSET, look_ahead=0, screen_w=0, kernel=KERNEL, dt=dt, replay=replay)
+
+
+@pytest.mark.parametrize('dt', [0.1, 0.2, 0.3])
+def test_replay_tables_match_cars_smoothing_their_trajectory(dt):
+    df = _time_slot()
+    index = TrajectoryIndex(df)
+    replay = ReplayKinematics.build(index, df, KERNEL, dt, X_OFFSET, Y_OFFSET)
+    for vehicle_id, (start, end) in index.rows.items():
+        trajectory, max_t, speeds = _smoothed_trajectory(index.vehicle_rows(df, vehicle_id, 0), dt)
+        car = _car(None, dt, replay=(replay, start))
+        assert car._max_t == max_t
+        numpy.testing.assert_array_equal(car._trajectory, trajectory)  # bit for bit, not approximately
+        numpy.testing.assert_array_equal(car._speeds[:max_t + 1], speeds)
+
+
+@pytest.mark.parametrize('dt', [0.1, 0.3])
+def test_cars_spawned_mid_trajectory_smooth_it_from_there(dt):
+    df = _time_slot()
+    index = TrajectoryIndex(df)
+    car_dfs = dict()
+    for vehicle_id, (start, end) in index.rows.items():
+        frame = index.frame[start + (end - start) // 3]
+        car_df = index.vehicle_rows(df, vehicle_id, frame)
+        if len(car_df) >= KERNEL + 1: car_dfs[vehicle_id] = car_df
+    # the rows left of every car, smoothed all at once, as I80._get_spawn_replays does
+    spawn_df = pd.concat(car_dfs.values())
+    spawn_index = TrajectoryIndex(spawn_df)
+    replay = ReplayKinematics.build(spawn_index, spawn_df, KERNEL, dt, X_OFFSET, Y_OFFSET)
+    for vehicle_id, car_df in car_dfs.items():
+        trajectory, max_t, speeds = _smoothed_trajectory(car_df, dt)
+        for car in _car(car_df, dt), _car(None, dt, replay=(replay, spawn_index.rows[vehicle_id][0])):
+            assert car._max_t == max_t
+            numpy.testing.assert_array_equal(car._trajectory, trajectory)
+            numpy.testing.assert_array_equal(car._speeds[:max_t + 1], speeds)
@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+
+import numpy
+
+import shards
+
+
+def _episode(length, seed):
+    rng = numpy.random.RandomState(seed)
+    return dict(
+        images=rng.randint(0, 256, (length, 3, 117, 24)).astype(numpy.uint8),
+        states=rng.randn(length, 7, 4).astype(numpy.float32),
+        actions=rng.randn(length, 2).astype(numpy.float32),
+        costs=rng.rand(length, 2).astype(numpy.float32),
+        ego_car=(rng.rand(117, 24) > 0.5).astype(numpy.uint8),
+    )
+
+
+def _append_and_die(shard_dir, n_episodes):
+    writer = shards.ShardWriter(shard_dir, resume=True)
+    for e in range(n_episodes):
+        writer.append(f'car{e}.pkl', _episode(10 + e, e))
+    os._exit(1)  # hard kill, before any checkpoint after the one of __init__
+
+
+def test_resume_after_kill(tmp_path):
+    shard_dir = str(tmp_path)
+    process = multiprocessing.get_context('fork').Process(target=_append_and_die, args=(shard_dir, 5))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+    assert not shards.ShardStore.exists(shard_dir)
+
+    with shards.ShardWriter(shard_dir, resume=True) as writer:
+        assert writer.ids == []
+        for e in range(5):
+            writer.append(f'car{e}.pkl', _episode(10 + e, e))
+    shard = shards.ShardStore(shard_dir)
+    assert shard.ids == [f'car{e}.pkl' for e in range(5)]
+    for e, (offset, length) in enumerate(shard.index):
+        episode = _episode(10 + e, e)
+        numpy.testing.assert_array_equal(shard.images[offset:offset + length], episode['images'])
+        numpy.testing.assert_array_equal(shard.ego_car_masks[shard.ego_car_index[e]], episode['ego_car'])
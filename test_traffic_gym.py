@@ -0,0 +1,71 @@
+import numpy
+import PIL.Image  # used by Car._get_observation_image, imported elsewhere by the simulators
+import pygame
+import pytest
+
+from traffic_gym import LANE_W, MAX_SPEED, SCALE, Car, colours, get_ego_views
+
+WIDTH_HEIGHT = numpy.array((2 * MAX_SPEED * 1000 / 3600 * SCALE, 4 * LANE_W))
+M = int(numpy.linalg.norm(WIDTH_HEIGHT) / 2)  # max_extension of Simulator.render
+SIZE = (1200, 400)
+
+
+def _scene():
+    # lanes in red, vehicles in green, as the machine-mode render
+    surface = pygame.Surface(SIZE)
+    for y in range(M, SIZE[1] - M + 1, LANE_W):
+        pygame.draw.line(surface, colours['r'], (0, y), (SIZE[0], y), 1)
+    rng = numpy.random.RandomState(0)
+    for _ in range(60):
+        x, y = rng.randint(0, SIZE[0]), rng.randint(0, SIZE[1])
+        pygame.draw.rect(surface, colours['g'], (x, y, 29, 11))
+    return surface
+
+
+def _car(position, direction):
+    car = Car(({'mid': 0},), {0}, 0.1, 0, 0, SIZE[0], None, None)
+    car._position = numpy.array(position, dtype=numpy.float64) - M
+    car._direction = numpy.array(direction, dtype=numpy.float64) / numpy.linalg.norm(direction)
+    car._speed = 20 * SCALE
+    car._states_image.append(('last state image', 0, 0, 0))
+    return car
+
+
+@pytest.mark.parametrize('position, direction, on_surface', [
+    ((600, 200), (1, 0), True),
+    ((500, 220), (0.96, 0.28), True),
+    ((700, 180), (0.99, -0.12), True),
+    ((600, 395), (1, 0), False),  # past the bottom edge
+    ((600, 5), (1, 0), False),  # past the top edge
+    ((40, 200), (1, 0), False),  # past the left edge
+])
+def test_ego_views_match_observation_images(position, direction, on_surface):
+    surface = _scene()
+    batched, single = _car(position, direction), _car(position, direction)
+    footprint = pygame.Rect(0, 0, 1, 1)  # the ego car is not drawn: nothing to take out of the scene
+    patch = pygame.surfarray.array2d(surface.subsurface(footprint))
+    images, costs = get_ego_views(surface, [batched], [footprint], [patch], M, WIDTH_HEIGHT, 0.25)
+    observation = single._get_observation_image(M, surface, WIDTH_HEIGHT, 0.25, 0)
+    if not on_surface:
+        assert images == [None] and costs == [None] and single.off_screen
+        return
+    image, lane_cost, proximity_cost, _ = observation
+    assert costs[0] == (lane_cost, proximity_cost)
+    # images differ only by the rounding of the resize (red is scaled by 4)
+    assert images[0].shape == image.shape
+    difference = (images[0].int() - image.int()).abs()
+    assert difference[..., 0].max() <= 4 and difference[..., 1:].max() <= 1
+
+
+def test_ego_views_of_vehicles_on_and_off_the_surface():
+    surface = _scene()
+    cars = [_car((600, 200), (1, 0)), _car((600, 395), (1, 0)), _car((500, 220), (0.96, 0.28))]
+    footprints = [pygame.Rect(0, 0, 1, 1)] * len(cars)
+    patches = [pygame.surfarray.array2d(surface.subsurface(f)) for f in footprints]
+    images, costs = get_ego_views(surface, cars, footprints, patches, M, WIDTH_HEIGHT, 0.25)
+    assert images[1] is None and costs[1] is None
+    for b in 0, 2:
+        image, lane_cost, proximity_cost, _ = _car(cars[b]._position + M, cars[b]._direction)._get_observation_image(
+            M, surface, WIDTH_HEIGHT, 0.25, 0)
+        assert costs[b] == (lane_cost, proximity_cost)
+        assert (images[b].int() - image.int()).abs().max() <= 4
@@ -1,6 +1,8 @@
 import bisect
 
 import pygame, pdb, torch
+import torch.nn.functional as F
+import functools
 import math, numpy
 import random
 import numpy as np
@@ -60,11 +62,249 @@ colours = {
 MAX_SPEED = 130  # km/h
 
 
+class VehicleArrays:
+    """
+    Kinematic state (position, direction, speed) of many vehicles, in contiguous arrays
+
+    An attached vehicle reads and writes its kinematics in one row of the arrays, through the ``_Kinematics``
+    attributes of ``Car``, so that policies and ``store()`` work unchanged, while ``step()`` integrates all of them at
+    once.
+    """
+
+    def __init__(self, capacity=256):
+        self.position = np.zeros((capacity, 2))
+        self.direction = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.dt = np.zeros(capacity)
+        self.vehicles = list()  # row -> vehicle
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def attach(self, car):
+        n = len(self.vehicles)
+        if n == len(self.speed):  # grow by doubling
+            for name in ('position', 'direction', 'speed', 'dt'):
+                array = getattr(self, name)
+                setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self.position[n] = car._position
+        self.direction[n] = car._direction
+        self.speed[n] = car._speed
+        self.dt[n] = car._dt
+        self.vehicles.append(car)
+        car._kinematics = self, n
+
+    def detach(self, car):
+        _, row = car._kinematics
+        # give the car its own copy of the kinematics back
+        position, direction, speed = self.position[row].copy(), self.direction[row].copy(), self.speed[row].item()
+        car._kinematics = None
+        car._position, car._direction, car._speed = position, direction, speed
+        # fill the hole with the last row, to keep the arrays compact
+        last = len(self.vehicles) - 1
+        if row != last:
+            moved = self.vehicles[last]
+            for array in self.position, self.direction, self.speed, self.dt:
+                array[row] = array[last]
+            self.vehicles[row] = moved
+            moved._kinematics = self, row
+        self.vehicles.pop()
+
+    def snapshot(self):
+        return {name: getattr(self, name).copy() for name in ('position', 'direction', 'speed', 'dt', 'vehicles')}
+
+    def restore(self, snapshot):
+        for name, x in snapshot.items(): setattr(self, name, x.copy())
+
+    def step(self, vehicles, actions):
+        """
+        Batched ``Car.step``
+        :param vehicles: attached vehicles to update
+        :param actions: one (acceleration, steering) action per vehicle
+        """
+        if not vehicles: return
+        rows = np.array([v._kinematics[1] for v in vehicles])
+        actions = np.array([np.asarray(a, dtype=np.float64) for a in actions]).reshape(-1, 2)
+        a, b = actions[:, 0], actions[:, 1]
+        direction, speed, dt = self.direction[rows], self.speed[rows], self.dt[rows]
+
+        # State integration, as in Car.step
+        self.position[rows] += speed[:, None] * direction * dt[:, None]
+
+        ortho_direction = np.stack((direction[:, 1], -direction[:, 0]), axis=1)
+        direction_vector = direction + ortho_direction * b[:, None] * speed[:, None] * dt[:, None]
+        norm = np.linalg.norm(direction_vector, axis=1, keepdims=True)
+        self.direction[rows] = direction_vector / (norm + 1e-3)
+
+        self.speed[rows] = speed + a * dt
+
+        for v in vehicles: v._update_passing()
+
+
+class NeighbourIndex:
+    """
+    Vehicles behind and ahead of every vehicle, in its own and in the adjacent lanes, for one frame
+
+    Vehicles are sorted by (lane, front x), as in a ``lane_occupancy`` built with ``bisect.insort``, and all neighbours
+    are found at once, with one ``searchsorted`` per lane and lane offset. ``neighbours(i, d_lane)`` then returns what
+    ``Simulator._get_neighbours`` would.
+    """
+
+    def __init__(self, vehicles, lanes, nb_lanes):
+        """
+        :param vehicles: list of vehicles
+        :param lanes: the (only) lane of each vehicle
+        :param nb_lanes: number of lanes
+        """
+        n = len(vehicles)
+        self.vehicles = vehicles
+        self.nb_lanes = nb_lanes
+        lanes = np.array(lanes, dtype=np.int64).reshape(n)
+        front = np.array([v.front[0] for v in vehicles], dtype=np.float64).reshape(n)
+
+        # sort by lane, then by front x, then by list order (insort puts equal vehicles after the ones already there)
+        self.order = np.lexsort((front, lanes))
+        sorted_front = front[self.order]
+        # vehicles of lane l: order[bounds[l]:bounds[l + 1]]
+        self.bounds = np.searchsorted(lanes[self.order], np.arange(nb_lanes + 1))
+        rank = np.empty(n, dtype=np.int64)
+        rank[self.order] = np.arange(n)
+
+        # for d_lane in (-1, 0, +1), position (in order) of the vehicle behind / ahead, -1 if there is none
+        self.behind = np.full((3, n), -1, dtype=np.int64)
+        self.ahead = np.full((3, n), -1, dtype=np.int64)
+        for d_lane in (-1, 0, 1):
+            target = lanes + d_lane
+            for l in range(nb_lanes):
+                query = np.flatnonzero(target == l)
+                if len(query) == 0: continue
+                start, end = self.bounds[l], self.bounds[l + 1]
+                # first vehicle strictly ahead, as bisect.bisect
+                ahead = start + np.searchsorted(sorted_front[start:end], front[query], side='right')
+                behind = ahead - 1
+                if d_lane == 0:  # skip myself, I'm in my own lane
+                    behind[behind == rank[query]] -= 1
+                self.behind[d_lane + 1, query] = np.where(behind >= start, behind, -1)
+                self.ahead[d_lane + 1, query] = np.where(ahead < end, ahead, -1)
+
+    def neighbours(self, i, d_lane):
+        """
+        :param i: index of the vehicle in ``vehicles``
+        :param d_lane: -1, 0, +1 for the left, current, right lane
+        :return: (behind, ahead) vehicles, or None
+        """
+        behind, ahead = self.behind[d_lane + 1, i], self.ahead[d_lane + 1, i]
+        return (self.vehicles[self.order[behind]] if behind >= 0 else None,
+                self.vehicles[self.order[ahead]] if ahead >= 0 else None)
+
+    def lane_occupancy(self):
+        """
+        :return: vehicles of every lane, sorted by front x
+        """
+        return [[self.vehicles[i] for i in self.order[self.bounds[l]:self.bounds[l + 1]]] for l in range(self.nb_lanes)]
+
+
+class _Kinematics:
+    """
+    Car attribute living either on the car itself or, when the car is attached to a ``VehicleArrays``, in its row
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.array = name[1:]
+
+    def __get__(self, car, owner=None):
+        if car is None: return self
+        attached = car.__dict__.get('_kinematics')
+        if attached is None: return car.__dict__[self.name]
+        arrays, row = attached
+        return getattr(arrays, self.array)[row]
+
+    def __set__(self, car, value):
+        attached = car.__dict__.get('_kinematics')
+        if attached is None:
+            car.__dict__[self.name] = value
+        else:
+            arrays, row = attached
+            getattr(arrays, self.array)[row] = value
+
+
+class History:
+    """
+    Entries (tuples of tensors and numbers) stored at every step by a car, in one preallocated array per field
+
+    With a capacity, only the last ``capacity`` entries are kept, in a ring buffer where every entry is written twice
+    (at rows i and i + capacity), so that the last entries are always a contiguous slice. Otherwise, all the entries
+    are kept, and the arrays grow by ``chunk`` entries.
+    """
+
+    def __init__(self, capacity=None, chunk=256):
+        self.capacity = capacity
+        self.chunk = chunk
+        self.fields = None
+        self.count = 0  # entries appended so far
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i >= 0: i -= self.count
+        return tuple(field[0] for field in self.last(-i))
+
+    @staticmethod
+    def _empty(x, size):
+        if torch.is_tensor(x): return torch.empty((size, *x.shape), dtype=x.dtype)
+        return np.empty(size, np.asarray(x).dtype)
+
+    def append(self, entry):
+        if self.fields is None:
+            self.fields = [self._empty(x, 2 * self.capacity if self.capacity else self.chunk) for x in entry]
+        if self.capacity:
+            rows = self.count % self.capacity, self.count % self.capacity + self.capacity
+        else:
+            if self.count == len(self.fields[0]):
+                fields, self.fields = self.fields, [self._empty(f[0], self.count + self.chunk) for f in self.fields]
+                for new, old in zip(self.fields, fields): new[:self.count] = old
+            rows = self.count,
+        for field, x in zip(self.fields, entry):
+            for row in rows: field[row] = x
+        self.count += 1
+
+    def last(self, n):
+        """
+        Last n entries, as views, overwritten by later appends
+        :param n: number of entries
+        :return: (n, ...) tensor or array, per field
+        """
+        if not 0 < n <= min(self.count, self.capacity or self.count): raise IndexError(f'{n} entries out of {self}')
+        end = (self.count - 1) % self.capacity + self.capacity + 1 if self.capacity else self.count
+        return tuple(field[end - n:end] for field in self.fields)
+
+    def copy(self):
+        """
+        Copy sharing the stored entries, which are never overwritten (unless in a ring buffer, which is copied)
+        """
+        history = History(self.capacity, self.chunk)
+        history.count = self.count
+        history.fields = self.fields
+        if self.capacity and self.fields is not None:
+            history.fields = [f.clone() if torch.is_tensor(f) else f.copy() for f in self.fields]
+        return history
+
+    def __repr__(self):
+        return f'History(count={self.count}, capacity={self.capacity})'
+
+
 class Car:
     # Global constants
     SCALE = SCALE
     LANE_W = LANE_W
 
+    # Kinematics, possibly stored in a VehicleArrays
+    _position = _Kinematics()
+    _direction = _Kinematics()
+    _speed = _Kinematics()
+
     def __init__(self, lanes, free_lanes, dt, car_id, look_ahead, screen_w, font, policy_type, policy_network=None):
         """
         Initialise a sedan on a random lane
@@ -97,16 +337,16 @@ class Car:
         self._noisy_target_lane = self._target_lane
         self.crashed = False
         self._error = 0
-        self._states = list()
-        self._states_image = list()
+        self._states = History()
+        self._states_image = History()
         self._ego_car_image = None
-        self._actions = list()
+        self._actions = History()
         self._safe_factor = random.gauss(1.5, 0)  # 0.9 Germany, 2 safe
         self.pid_k1 = np.random.normal(1e-4, 1e-5)
         self.pid_k2 = np.random.normal(1e-3, 1e-4)
         self.look_ahead = look_ahead
         self.screen_w = screen_w
-        self._text = self.get_text(self.id, font)
+        self._text = self.get_text(self.id, font) if font is not None else None  # no labels when headless
         self._policy_type = policy_type
         self.policy_network = policy_network
         self.is_controlled = False
@@ -146,7 +386,7 @@ class Car:
         obs = torch.zeros(n_cars, 2, 2)
         mask = torch.zeros(n_cars)
         obs = obs.view(n_cars, 4)
-        cost = 0
+        cost = 0.
 
         v_state = self.get_state()
         obs[0].copy_(v_state)
@@ -249,12 +489,13 @@ class Car:
             _r = draw_rect(surface, self._colour, rectangle, d)
 
             # Drawing vehicle number
-            if x < self.front[0]:
-                self._text[1].left = x
-            else:
-                self._text[1].right = x
-            self._text[1].top = y - self._width // 2
-            surface.blit(self._text[0], self._text[1])
+            if self._text is not None:
+                if x < self.front[0]:
+                    self._text[1].left = x
+                else:
+                    self._text[1].right = x
+                self._text[1].top = y - self._width // 2
+                surface.blit(self._text[0], self._text[1])
 
             if self._braked: self._colour = colours['g']
             return _r
@@ -281,6 +522,9 @@ class Car:
 
         self._speed += a * self._dt
 
+        self._update_passing()
+
+    def _update_passing(self):
         # Deal with latent variable and visual indicator
         if self._passing and abs(self._error) < 0.5:
             self._passing = False
@@ -464,30 +708,44 @@ class Car:
         y = np.ceil((surf_h - self.LANE_W) / 2)
         neighbourhood = rot_surface.subsurface(x, y, self._length, self.LANE_W)
         neighbourhood_array = pygame.surfarray.array3d(neighbourhood).transpose(1, 0, 2)  # flip x and y
-        lanes = neighbourhood_array[:, :, 0]
-        lane_mask = np.broadcast_to((1 - abs(np.linspace(-1, 1, self.LANE_W))).reshape(-1, 1), lanes.shape)
-        lane_cost = (lanes * lane_mask).max() / 255
+        lane_cost, proximity_cost = self._get_costs(neighbourhood_array[:, :, 0], sub_rot_array[:, :, 1])
+
+        # # Draw boxes, for visualisation purpose
+        # # init as: env.reset(time_interval=1, frame=2510, control=False)
+        # if self.id in (1033, 987, 992, 958, 961):
+        #     w, h = width_height
+        #     points = np.array(((w, -h), (-w, -h), (-w, h), (w, h))) / 2
+        #     c, s = d
+        #     rot = np.array(((c, -s), (s, c)))
+        #     rot_points = (rot @ points.T).T + centre + m
+        #     pygame.draw.polygon(screen_surface, colours['c'], rot_points, 1)
+        #     imsave(f'car {self.id}.png', sub_rot_array_scaled_up)
+
+        # self._colour = (255 * lane_cost, 0, 255 * (1 - lane_cost))
+
+        # return state_image, lane_cost, proximity_cost, frame
+        return torch.from_numpy(sub_rot_array_scaled_up.copy()), lane_cost, proximity_cost, global_frame
 
-        # Compute x/y minimum distance to other vehicles (pixel version)
+    def _get_cost_masks(self, crop_h, crop_w):
+        """
+        Lane and proximity masks of the pixel costs, for a (crop_h, crop_w) crop around the car
+        """
         # Account for 1 metre overlap (low data accuracy)
         alpha = 1 * self.SCALE  # 1 m overlap collision
-        # Create separable proximity mask
-        crop_h, crop_w, _ = sub_rot_array.shape
         max_x = np.ceil((crop_w - max(self._length - alpha, 0)) / 2)
-        max_y = np.ceil((crop_h - max(self._width - alpha, 0)) / 2)
-        min_x = max(np.ceil(max_x - self.safe_distance), 0)
-        min_y = np.ceil(crop_h / 2 - self._width)  # assumes other._width / 2 = self._width / 2
-        x_filter = (1 - abs(np.linspace(-1, 1, crop_w))) * crop_w / 2  # 45 degree
-        x_filter[x_filter > max_x] = max_x  # chop off top
-        x_filter[x_filter < min_x] = min_x  # chop off bottom
-        x_filter = (x_filter - min_x) / (max_x - min_x)  # normalise
-        y_filter = (1 - abs(np.linspace(-1, 1, crop_h))) * crop_h / 2  # 45 degree
-        y_filter[y_filter > max_y] = max_y  # chop off top
-        y_filter[y_filter < min_y] = min_y  # chop off bottom
-        y_filter = (y_filter - min_y) / (max_y - min_y)  # normalise
-        proximity_mask = y_filter.reshape(-1, 1) @ x_filter.reshape(1, -1)
-        # Compute cost
-        vehicles = sub_rot_array[:, :, 1]  # flip x and y, get green
+        # the safe distance is quantised to whole pixels, so masks are shared across frames (and vehicles)
+        min_x = int(max(np.ceil(max_x - self.safe_distance), 0))
+        return get_cost_masks(self.LANE_W, crop_h, crop_w, self._length, self._width, alpha, min_x)
+
+    def _get_costs(self, lanes, vehicles):
+        """
+        Pixel lane and proximity costs
+        :param lanes: red channel of the (LANE_W, length) neighbourhood of the car, facing right
+        :param vehicles: green channel of the full resolution crop around the car, facing right
+        :return: lane cost, proximity cost
+        """
+        lane_mask, proximity_mask = self._get_cost_masks(*vehicles.shape)
+        lane_cost = (lanes * lane_mask).max() / 255
         proximity_cost = (vehicles * proximity_mask).max() / 255
 
         # Inspecting collisions
@@ -500,46 +758,63 @@ class Car:
         #             'sub_rot_array': sub_rot_array,
         #         }, f)
 
-        # # Draw boxes, for visualisation purpose
-        # # init as: env.reset(time_interval=1, frame=2510, control=False)
-        # if self.id in (1033, 987, 992, 958, 961):
-        #     w, h = width_height
-        #     points = np.array(((w, -h), (-w, -h), (-w, h), (w, h))) / 2
-        #     c, s = d
-        #     rot = np.array(((c, -s), (s, c)))
-        #     rot_points = (rot @ points.T).T + centre + m
-        #     pygame.draw.polygon(screen_surface, colours['c'], rot_points, 1)
-        #     imsave(f'car {self.id}.png', sub_rot_array_scaled_up)
-
-        # self._colour = (255 * lane_cost, 0, 255 * (1 - lane_cost))
+        return lane_cost, proximity_cost
 
-        # return state_image, lane_cost, proximity_cost, frame
-        return torch.from_numpy(sub_rot_array_scaled_up.copy()), lane_cost, proximity_cost, global_frame
+    def _get_observation_from_view(self, state_image, costs, global_frame):
+        """
+        Same as _get_observation_image, from what get_ego_views extracted
+        """
+        if costs is None:  # if the agent fucks up
+            print(f'{self} fucked up')  # notify about the event
+            self.off_screen = True  # we're off_screen
+            return self._states_image[-1]  # return last state
+        return (state_image, *costs, global_frame)
 
     def store(self, object_name, object_):
         if object_name == 'action':
-            self._actions.append(torch.Tensor(object_))
+            self._actions.append((torch.Tensor(object_),))
         elif object_name == 'state':
             self._states.append(self._get_obs(*object_))
         elif object_name == 'state_image':
             self._states_image.append(self._get_observation_image(*object_))
+        elif object_name == 'ego_view':
+            self._states_image.append(self._get_observation_from_view(*object_))
         elif object_name == 'ego_car_image' and self._ego_car_image is None:
             self._ego_car_image = self._get_observation_image(*object_)[0]
 
+    @staticmethod
+    def _copy_state(state):
+        # histories share their entries, containers and writable arrays (e.g. the position, updated in place) are
+        # copied, read-only arrays (e.g. replayed kinematics) are shared
+        return {name: x.copy() if isinstance(x, (History, list, dict, set)) or
+                isinstance(x, np.ndarray) and x.flags.writeable else x for name, x in state.items()}
+
+    def snapshot(self):
+        """
+        State of the car, to restore() it later
+        """
+        return self._copy_state(self.__dict__)
+
+    def restore(self, snapshot):
+        self.__dict__.clear()
+        self.__dict__.update(self._copy_state(snapshot))
+
+    def bound_history(self, n):
+        """
+        Keep only the last n states, state images and actions (of a car which is not dumped)
+        """
+        self._states, self._states_image, self._actions = History(n), History(n), History(n)
+
     def get_last(self, n, done, norm_state=False, return_reward=False, gamma=0.99):
         if len(self._states_image) < n: return None  # no enough samples
-        # n × (state_image, lane_cost, proximity_cost, frame) ->
-        # -> (n × state_image, n × lane_cost, n × proximity_cost, n × frame)
-        transpose = list(zip(*self._states_image))
-        state_images = transpose[0]
-        state_images = torch.stack(state_images).permute(0, 3, 1, 2)[-n:]
+        # (n × state_image, n × lane_cost, n × proximity_cost, n × frame), as views of the history
+        state_images = self._states_image.last(n)[0].permute(0, 3, 1, 2)
         ego_car_new_shape = list(state_images.shape)
         ego_car_new_shape[1] = 1
         ego_car_channel = self._ego_car_image[:, :, 2][None, None, :].expand(ego_car_new_shape)
         state_images = torch.cat((state_images, ego_car_channel), 1)
 
-        zip_ = list(zip(*self._states))  # n × (obs, mask, cost) -> (n × obs, n × mask, n × cost)
-        states = torch.stack(zip_[0])[:, 0][-n:]  # select the ego-state (of 1 + 6 states we keep track)
+        states = self._states.last(n)[0][:, 0]  # select the ego-state (of 1 + 6 states we keep track)
         if norm_state is not False:  # normalise the states, if requested
             states = states.sub(norm_state['s_mean']).div(norm_state['s_std'])  # N(0, 1) range
             state_images = state_images.float().div(255)  # [0, 1] range
@@ -574,31 +849,28 @@ class Car:
 
     def dump_state_image(self, save_dir='scratch/', mode='img'):
         os.system('mkdir -p ' + save_dir)
-        transpose = list(zip(*self._states_image))
-        if len(transpose) == 0:
+        if len(self._states_image) == 0:
             print(f'failure, {save_dir}')
-            # print(transpose)
             return
-        im = transpose[0]
+        # clone the views of the history, or their whole buffers would be pickled
+        im, lane_cost, pixel_proximity_cost, frames = self._states_image.last(len(self._states_image))
         if mode == 'tensor':
-            lane_cost = torch.Tensor(transpose[1])
-            pixel_proximity_cost = torch.Tensor(transpose[2])
-            frames = np.array(transpose[3])
-            zip_ = list(zip(*self._states))
-            proximity_cost = torch.Tensor(zip_[2])
-            states = torch.stack(zip_[0])
-            mask = torch.stack(zip_[1])
+            lane_cost = torch.Tensor(lane_cost)
+            pixel_proximity_cost = torch.Tensor(pixel_proximity_cost)
+            frames = np.array(frames)
+            states, mask, proximity_cost = self._states.last(len(self._states))
+            proximity_cost = torch.Tensor(proximity_cost)
             # save in torch format
-            im_pth = torch.stack(im).permute(0, 3, 1, 2)
+            im_pth = im.clone().permute(0, 3, 1, 2)
             with open(os.path.join(save_dir, f'car{self.id}.pkl'), 'wb') as f:
                 pickle.dump({
                     'images': im_pth,
-                    'actions': torch.stack(self._actions),
+                    'actions': self._actions.last(len(self._actions))[0].clone(),
                     'lane_cost': lane_cost,
                     'pixel_proximity_cost': pixel_proximity_cost,
-                    'states': states,
+                    'states': states.clone(),
                     'proximity_cost': proximity_cost,
-                    'mask': mask,
+                    'mask': mask.clone(),
                     'frames': frames,
                     'ego_car': self._ego_car_image.permute(2, 0, 1),
                 }, f)
@@ -621,6 +893,162 @@ class Car:
         return self._length, self._width
 
 
+@functools.lru_cache(maxsize=4096)
+def get_cost_masks(lane_w, crop_h, crop_w, length, width, alpha, min_x):
+    """
+    Lane and proximity masks of Car._get_costs (read only, shared by all the vehicles with the same arguments)
+    :param lane_w: lane width, in pixels
+    :param crop_h: height of the crop around the car
+    :param crop_w: width of the crop around the car
+    :param length: length of the car
+    :param width: width of the car
+    :param alpha: tolerated overlap between vehicles
+    :param min_x: distance from the crop border where the proximity mask starts to rise (safe distance)
+    :return: (lane_w, 1) lane mask, (crop_h, crop_w) proximity mask
+    """
+    lane_mask = (1 - abs(np.linspace(-1, 1, lane_w))).reshape(-1, 1)
+
+    # Create separable proximity mask
+    max_x = np.ceil((crop_w - max(length - alpha, 0)) / 2)
+    max_y = np.ceil((crop_h - max(width - alpha, 0)) / 2)
+    min_y = np.ceil(crop_h / 2 - width)  # assumes other._width / 2 = self._width / 2
+    x_filter = (1 - abs(np.linspace(-1, 1, crop_w))) * crop_w / 2  # 45 degree
+    x_filter[x_filter > max_x] = max_x  # chop off top
+    x_filter[x_filter < min_x] = min_x  # chop off bottom
+    x_filter = (x_filter - min_x) / (max_x - min_x)  # normalise
+    y_filter = (1 - abs(np.linspace(-1, 1, crop_h))) * crop_h / 2  # 45 degree
+    y_filter[y_filter > max_y] = max_y  # chop off top
+    y_filter[y_filter < min_y] = min_y  # chop off bottom
+    y_filter = (y_filter - min_y) / (max_y - min_y)  # normalise
+    proximity_mask = y_filter.reshape(-1, 1) @ x_filter.reshape(1, -1)
+
+    lane_mask.flags.writeable = proximity_mask.flags.writeable = False
+    return lane_mask, proximity_mask
+
+
+def get_costs(lanes, neighbourhoods, vehicles, masks):
+    """
+    Pixel lane and proximity costs of many vehicles, as Car._get_costs, with a single masked max per cost
+    :param lanes: (B, h, w) red channel of the crops, facing right
+    :param neighbourhoods: (y, x, length) lane neighbourhood of every vehicle, in the crop
+    :param vehicles: (B, h, w) green channel of the crops, facing right
+    :param masks: lane and proximity masks of every vehicle, from Car._get_cost_masks
+    :return: (B,) lane costs, (B,) proximity costs
+    """
+    lane_masks, proximity_masks = zip(*masks)
+    # gather the neighbourhoods, padded to the longest vehicle
+    y, x, length = (np.array(n)[:, None, None] for n in zip(*neighbourhoods))
+    rows = y + np.arange(len(lane_masks[0]))[:, None]
+    cols = np.arange(length.max())
+    lanes = lanes[np.arange(len(lanes))[:, None, None], rows, x + cols] * (cols < length)
+    lane_costs = (lanes * np.stack(lane_masks)).max((1, 2)) / 255
+    proximity_masks = np.stack(proximity_masks)
+    proximity_costs = np.multiply(proximity_masks, vehicles, out=proximity_masks).max((1, 2)) / 255
+    return lane_costs, proximity_costs
+
+
+def get_ego_views(surface, vehicles, footprints, patches, m, width_height, scale):
+    """
+    State images of many vehicles, as Car._get_observation_image, resampling the scene once for all of them
+
+    Every crop pixel is mapped to the scene with the fixed point arithmetic of pygame.transform.rotate, so crops are
+    identical to the rotated subsurfaces. Crops are then scaled down all together, with an antialiased bilinear filter
+    (as PIL.Image.resize, up to rounding).
+    :param surface: machine-mode pygame surface
+    :param vehicles: ego vehicles
+    :param footprints: pygame.Rect where each vehicle is drawn on the surface
+    :param patches: (w, h) pixels2d array of each footprint, with the vehicle taken out of the scene
+    :param m: offset of the surface with respect to the vehicle coordinates
+    :param width_height: size of the crops, on the surface
+    :param scale: size of the state images, with respect to the crops
+    :return: (h', w', 3) uint8 state image facing upward, and (lane, proximity) costs, of every vehicle, both None if
+             its crop is out of the surface
+    """
+    width, height = surface.get_size()
+    crop_w, crop_h = (int(x) for x in np.floor(width_height))
+
+    # pygame.transform.rotate parameters of every vehicle's subsurface, and of the crop of the rotated subsurface
+    params, neighbourhoods, on_screen = list(), list(), list()
+    for v in vehicles:
+        d = v._direction
+        x_y = np.ceil(np.array((abs(d) @ width_height, abs(d) @ width_height[::-1])))
+        centre = v._position + (d * v._length) // 2
+        rect = pygame.Rect((*(centre + m - x_y / 2), *x_y))
+        on_screen.append(surface.get_rect().contains(rect))
+        angle = float(np.float32(np.arctan2(*d[::-1]) * 180 / np.pi)) * .01745329251994329
+        sin, cos = math.sin(angle), math.cos(angle)
+        rot_w = int(max(abs(cos * rect.w + sin * rect.h), abs(cos * rect.w - sin * rect.h)))
+        rot_h = int(max(abs(sin * rect.w + cos * rect.h), abs(sin * rect.w - cos * rect.h)))
+        i_sin, i_cos = int(sin * 65536), int(cos * 65536)
+        a_x = (rot_w << 15) - int(cos * ((rot_w - 1) << 15)) + ((rect.w - rot_w) << 15)
+        a_y = (rot_h << 15) - int(sin * ((rot_w - 1) << 15)) + ((rect.h - rot_h) << 15)
+        x_0, y_0 = (rot_w - crop_w) // 2, (rot_h - crop_h) // 2  # crop origin, in the rotated subsurface
+        # fixed point source of the crop origin, and of its neighbours
+        dx_0 = a_x + i_sin * (rot_h // 2 - y_0) + x_0 * i_cos
+        dy_0 = a_y - i_cos * (rot_h // 2 - y_0) + x_0 * i_sin
+        params.append((dx_0, dy_0, i_sin, i_cos, rect.w, rect.h, rect.x, rect.y))
+        # lane neighbourhood, in the crop
+        x = int(np.ceil((rot_w - v._length) / 2)) - x_0
+        y = int(np.ceil((rot_h - v.LANE_W) / 2)) - y_0
+        neighbourhoods.append((y, x, int(v._length)))
+
+    # crops not inside the surface have no view (Car._get_observation_image cannot take their subsurface either)
+    visible = [b for b, inside in enumerate(on_screen) if inside]
+    if not visible: return [None] * len(vehicles), [None] * len(vehicles)
+    vehicles, footprints, patches, params, neighbourhoods = (
+        [x[b] for b in visible] for x in (vehicles, footprints, patches, params, neighbourhoods))
+
+    # source pixel of every crop pixel, as an offset in the surface pixels buffer
+    pitch = surface.get_pitch() // 4
+    dx_0, dy_0, i_sin, i_cos, w, h, x_s, y_s = (x[:, None, None] for x in np.array(params, dtype=np.int64).T)
+    row = np.arange(crop_h, dtype=np.int64)[:, None]
+    col = np.arange(crop_w, dtype=np.int64)
+    sx = ((dx_0 + i_cos * col).astype(np.int32) - (i_sin * row).astype(np.int32)) >> 16
+    sy = ((dy_0 + i_sin * col).astype(np.int32) + (i_cos * row).astype(np.int32)) >> 16
+    # outside the subsurface, pygame fills with its top left pixel
+    inside = (sx.view(np.uint32) < w) & (sy.view(np.uint32) < h)
+    offset = sy
+    offset *= pitch
+    offset += sx
+    offset *= inside
+    offset += (x_s + y_s * pitch).astype(np.int32)
+    pixels = np.frombuffer(surface.get_buffer(), dtype=np.int32)
+    crops = pixels.take(offset)
+    del pixels  # unlock the surface
+
+    # every vehicle sees the scene with itself taken out: patch the crop pixels coming from its own footprint
+    for b, (footprint, patch, (dx_0, dy_0, i_sin, i_cos, _, _, x_s, y_s)) in enumerate(zip(footprints, patches, params)):
+        # crop pixel mapped to the centre of the footprint, and a margin including the whole footprint
+        x = (footprint.centerx - x_s) * 65536 - dx_0
+        y = (footprint.centery - y_s) * 65536 - dy_0
+        norm = i_cos ** 2 + i_sin ** 2
+        c, r = (i_cos * x + i_sin * y) / norm, (i_cos * y - i_sin * x) / norm
+        margin = footprint.w + footprint.h + 2
+        rows = slice(max(int(r) - margin, 0), max(int(r) + margin, 0))
+        cols = slice(max(int(c) - margin, 0), max(int(c) + margin, 0))
+        x, y = offset[b, rows, cols] % pitch - footprint.x, offset[b, rows, cols] // pitch - footprint.y
+        i, j = ((x.view(np.uint32) < footprint.w) & (y.view(np.uint32) < footprint.h)).nonzero()
+        crops[b, rows, cols][i, j] = patch[x[i, j], y[i, j]]
+
+    # unpack the mapped pixels into RGB
+    crops = crops.astype('<i4', copy=False).view(np.uint8).reshape(*crops.shape, 4)
+    crops = torch.from_numpy(crops[..., [shift // 8 for shift in surface.get_shifts()[:3]]]).permute(0, 3, 1, 2)
+
+    # scale down, and face upward
+    images = F.interpolate(crops.float(), size=(int(scale * crop_h), int(scale * crop_w)),
+                           mode='bilinear', align_corners=False, antialias=True)
+    images = images.round_().clamp_(0, 255).byte().rot90(1, (2, 3)).permute(0, 2, 3, 1).contiguous()
+    images[:, :, :, 0] *= 4
+
+    crops = crops.numpy()
+    masks = [v._get_cost_masks(crop_h, crop_w) for v in vehicles]
+    costs = get_costs(crops[:, 0], neighbourhoods, crops[:, 1], masks)
+    state_images, view_costs = [None] * len(on_screen), [None] * len(on_screen)
+    for b, image, c in zip(visible, images, zip(*costs)):
+        state_images[b], view_costs[b] = image, c
+    return state_images, view_costs
+
+
 class Simulator(core.Env):
     # Environment's car class
     EnvCar = Car
@@ -635,7 +1063,8 @@ class Simulator(core.Env):
 
     def __init__(self, display=True, nb_lanes=4, fps=30, delta_t=None, traffic_rate=15, state_image=False, store=False,
                  policy_type='hardcoded', nb_states=0, data_dir='', normalise_action=False, normalise_state=False,
-                 return_reward=False, gamma=0.99, show_frame_count=True, store_simulator_video=False):
+                 return_reward=False, gamma=0.99, show_frame_count=True, store_simulator_video=False, vectorised=False,
+                 batched_views=False):
 
         # Observation spaces definition
         self.observation_space = spaces.Box(low=-1, high=1, shape=(nb_states, STATE_D + STATE_C * STATE_H * STATE_W), dtype=np.float32)
@@ -669,8 +1098,14 @@ class Simulator(core.Env):
         self.nb_states = nb_states
         self.data_dir = data_dir
         self.user_is_done = None
+        self.vectorised = vectorised  # integrate all vehicles at once, with a VehicleArrays
+        self.kinematics = None
+        self.batched_views = batched_views  # extract all the state images at once, with get_ego_views
 
+        # without display (headless), pygame is not initialised and nothing is drawn for humans: no window, fonts, or
+        # vehicle labels, so that no video driver is needed
         self.display = display
+        self.font = None
         if self.display:  # if display is required
             pygame.init()  # init PyGame
             self.screen = pygame.display.set_mode(self.screen_size)  # set screen size
@@ -693,6 +1128,48 @@ class Simulator(core.Env):
     def seed(self, seed=None):
         self.random.seed(seed)
 
+    @staticmethod
+    def _copy_state(state):
+        state = dict(state)
+        for name in 'vehicles', 'controlled_car', 'vehicles_history':
+            if state.get(name) is not None: state[name] = state[name].copy()
+        if state.get('lane_occupancy') is not None: state['lane_occupancy'] = [l[:] for l in state['lane_occupancy']]
+        return state
+
+    def snapshot(self, global_random=False):
+        """
+        State of the episode (frame, vehicles and their histories, lane occupancy, controlled car, self.random),
+        to restore() it later, e.g. to branch many rollouts from the same frame without replaying the episode
+
+        Histories stored so far are shared with the snapshot, since they are only appended to, so taking a snapshot
+        costs a copy of the kinematic state of the vehicles, not of their observations.
+        :param global_random: also capture the random and numpy.random generators, which restore() then rewinds for
+                              all their users (e.g. the other environments of a VecEnv): only needed to replay a branch
+                              exactly when cars draw from them, as the sedans of this simulator do
+        """
+        cars = set(self.vehicles or ())
+        if self.controlled_car and self.controlled_car['locked']: cars.add(self.controlled_car['locked'])
+        if self.ghost: cars.add(self.ghost)
+        return dict(
+            simulator=self._copy_state(self.__dict__),
+            cars=[(car, car.snapshot()) for car in cars],
+            kinematics=self.kinematics.snapshot() if self.kinematics is not None else None,
+            random=self.random.getstate(),
+            global_random=(random.getstate(), np.random.get_state()) if global_random else None,
+        )
+
+    def restore(self, snapshot):
+        """
+        Go back to a snapshot(), which can be restored any number of times
+        """
+        self.__dict__.update(self._copy_state(snapshot['simulator']))
+        for car, state in snapshot['cars']: car.restore(state)
+        if self.kinematics is not None: self.kinematics.restore(snapshot['kinematics'])
+        self.random.setstate(snapshot['random'])
+        if snapshot['global_random'] is not None:
+            random.setstate(snapshot['global_random'][0])
+            np.random.set_state(snapshot['global_random'][1])
+
     def build_lanes(self, nb_lanes):
         return tuple(
             {'min': self.offset + n * self.LANE_W,
@@ -708,13 +1185,15 @@ class Simulator(core.Env):
         # Initialise environment state
         self.frame = 0
         self.vehicles = list()
+        self.kinematics = VehicleArrays() if self.vectorised else None
         self.lane_occupancy = [[] for _ in range(self.nb_lanes)]
         self.episode += 1
         # keep track of the car we are controlling
         self.next_car_id = 0
         self.mean_fps = None
         self.time_counter = 0
-        pygame.display.set_caption(f'Traffic simulator, episode {self.episode}, start from frame {self.frame}')
+        if self.display:
+            pygame.display.set_caption(f'Traffic simulator, episode {self.episode}, start from frame {self.frame}')
         if control:
             self.controlled_car = {
                 'locked': False,
@@ -766,7 +1245,7 @@ class Simulator(core.Env):
             # Remove from the environment cars outside the screen
             if v.back[0] > self.screen_size[0]:
                 for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
+                self._remove_vehicle(v)
 
             # Update available lane beginnings
             if v.back[0] < v.safe_distance:  # at most safe_distance ahead
@@ -776,10 +1255,10 @@ class Simulator(core.Env):
         if random.random() < self.traffic_rate * np.sin(2 * np.pi * self.frame * self.delta_t) * self.delta_t:
             if free_lanes:
                 car = self.EnvCar(self.lanes, free_lanes, self.delta_t, self.next_car_id,
-                                  self.look_ahead, self.screen_size[0], self.font[20], policy_type=self.policy_type,
-                                  policy_network=self.policy_network)
+                                  self.look_ahead, self.screen_size[0], self.font[20] if self.display else None,
+                                  policy_type=self.policy_type, policy_network=self.policy_network)
                 self.next_car_id += 1
-                self.vehicles.append(car)
+                self._add_vehicle(car)
                 for l in car.get_lane_set(self.lanes):
                     # Prepend the new car to each lane it can be found
                     self.lane_occupancy[l].insert(0, car)
@@ -795,9 +1274,10 @@ class Simulator(core.Env):
             if len(lane_set) == 0:
                 lanes_occupied = v.get_lane_set(self.lanes)
                 for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
+                self._remove_vehicle(v)
 
         states_images, states_raw, update = [], [], []
+        stepping, actions = [], []
         # print(len(self.vehicles))
         for v in self.vehicles:
             lane_set = v.get_lane_set(self.lanes)
@@ -806,7 +1286,7 @@ class Simulator(core.Env):
             if len(lane_set) == 0:
                 lanes_occupied = v.get_lane_set(self.lanes)
                 for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
+                self._remove_vehicle(v)
                 continue
 
             current_lane_idx = lane_set.pop()
@@ -854,7 +1334,15 @@ class Simulator(core.Env):
                     v.store('action', action)
 
                 # update the cars
-                v.step(action)
+                if self.kinematics is None:
+                    v.step(action)
+                else:
+                    stepping.append(v)
+                    actions.append(action)
+
+        # update all the cars at once, every policy having seen the same frame
+        if self.kinematics is not None:
+            self.kinematics.step(stepping, actions)
 
         if self.policy_type == 'imitation' and len(self.vehicles) > 0:
             # update the cars
@@ -891,6 +1379,14 @@ class Simulator(core.Env):
         # return observation, reward, done, info
         return None, None, False, self.vehicles
 
+    def _add_vehicle(self, car):
+        self.vehicles.append(car)
+        if self.kinematics is not None: self.kinematics.attach(car)
+
+    def _remove_vehicle(self, v):
+        self.vehicles.remove(v)
+        if self.kinematics is not None: self.kinematics.detach(v)
+
     def _get_neighbours(self, current_lane_idx, d_lane, v):
         # Shallow copy the target lane
         target_lane = self.lane_occupancy[current_lane_idx + d_lane][:]
@@ -965,36 +1461,46 @@ class Simulator(core.Env):
                 lane_surface = pygame.Surface(machine_screen_size)
                 self._draw_lanes(lane_surface, mode=mode, offset=max_extension)
 
-            # # draw vehicles
-            # for v in self.vehicles:
-            #     v.draw(vehicle_surface, mode=mode, offset=max_extension)
-            #
-            # vehicle_surface.blit(lane_surface, (0, 0), special_flags=pygame.BLEND_MAX)
+            # draw all the vehicles (in green) once, and superimpose the lanes
+            footprints = [v.draw(vehicle_surface, mode=mode, offset=max_extension) for v in self.vehicles]
+            vehicle_surface.blit(lane_surface, (0, 0), special_flags=pygame.BLEND_MAX)
 
             # extract states
             ego_surface = pygame.Surface(machine_screen_size)
-            for i, v in enumerate(self.vehicles):
+            egos = list()
+            for v, footprint in zip(self.vehicles, footprints):
                 if (self.store or v.is_controlled) and v.valid:
-                    # For every vehicle we want to extract the state, start with a black surface
+                    # Take myself out of the scene, redrawing my footprint with the other vehicles only
+                    scene_patch = vehicle_surface.subsurface(footprint).copy()
+                    vehicle_surface.set_clip(footprint)
                     vehicle_surface.fill((0, 0, 0))
-                    # Draw all the other vehicles (in green)
-                    for vv in set(self.vehicles) - {v}:
-                        vv.draw(vehicle_surface, mode=mode, offset=max_extension)
-                    # Superimpose the lanes
-                    vehicle_surface.blit(lane_surface, (0, 0), special_flags=pygame.BLEND_MAX)
-                    # Empty ego-surface
-                    ego_surface.fill((0, 0, 0))
-                    # Draw myself blue on the ego_surface
-                    ego_rect = v.draw(ego_surface, mode='ego-car', offset=max_extension)
-                    # Add me on top of others without shadowing
-                    # vehicle_surface.blit(ego_surface, ego_rect, ego_rect, special_flags=pygame.BLEND_MAX)
-                    v.store('state_image', (max_extension, vehicle_surface, width_height, scale, self.frame))
-                    v.store('ego_car_image', (max_extension, ego_surface, width_height, scale, self.frame))
+                    for vv, vv_footprint in zip(self.vehicles, footprints):
+                        if vv is not v and footprint.colliderect(vv_footprint):
+                            vv.draw(vehicle_surface, mode=mode, offset=max_extension)
+                    vehicle_surface.blit(lane_surface, footprint, footprint, special_flags=pygame.BLEND_MAX)
+                    vehicle_surface.set_clip(None)
+                    if self.batched_views:
+                        egos.append((v, footprint, pygame.surfarray.array2d(vehicle_surface.subsurface(footprint))))
+                    else:
+                        v.store('state_image', (max_extension, vehicle_surface, width_height, scale, self.frame))
+                    # Draw myself blue on the (empty) ego-surface, the first time only
+                    if v._ego_car_image is None:
+                        ego_rect = v.draw(ego_surface, mode='ego-car', offset=max_extension)
+                        v.store('ego_car_image', (max_extension, ego_surface, width_height, scale, self.frame))
+                        ego_surface.fill((0, 0, 0), ego_rect)
                     # Store whole history, if requested
                     if self.store_sim_video:
+                        video_surface = vehicle_surface.copy()
                         if self.ghost:
-                            self.ghost.draw(vehicle_surface, mode='ghost', offset=max_extension)
-                        v.frames.append(pygame.surfarray.array3d(vehicle_surface).transpose(1, 0, 2))  # flip x and y
+                            self.ghost.draw(video_surface, mode='ghost', offset=max_extension)
+                        v.frames.append(pygame.surfarray.array3d(video_surface).transpose(1, 0, 2))  # flip x and y
+                    # Put myself back
+                    vehicle_surface.blit(scene_patch, footprint)
+
+            if egos:
+                state_images, costs = get_ego_views(vehicle_surface, *zip(*egos), max_extension, width_height, scale)
+                for (v, _, _), state_image, c in zip(egos, state_images, costs):
+                    v.store('ego_view', (state_image, c, self.frame))
 
             # # save surface as image, for visualisation only
             # pygame.image.save(vehicle_surface, "vehicle_surface.png")
@@ -35,6 +35,11 @@ parser.add_argument('-epoch_size', type=int, default=1000)
 parser.add_argument('-combine', type=str, default='add')
 parser.add_argument('-grad_clip', type=float, default=50)
 parser.add_argument('-debug', action='store_true')
+parser.add_argument('-num_workers', type=int, default=0, help='threads assembling batches ahead (0: synchronous)')
+parser.add_argument('-prefetch', type=int, default=4, help='max number of batches assembled ahead')
+parser.add_argument('-cache_size', type=int, default=0,
+                    help='MB of whole episodes cached in memory (0: read windows through the OS page cache)')
+parser.add_argument('-windows_per_episode', type=int, default=1, help='windows sampled from each episode')
 parser.add_argument('-enable_tensorboard', action='store_true',
                     help='Enables tensorboard logging.')
 parser.add_argument('-tensorboard_dir', type=str, default='models/policy_networks',
@@ -67,17 +72,31 @@ print(f'[will save model as: {opt.model_file}]')
 if opt.warmstart == 0:
     prev_model = ''
 
-policy = models.PolicyMDN(opt, npred=opt.npred)
-policy.intype('gpu')
-
-optimizer = optim.Adam(policy.parameters(), opt.lrt, eps=1e-3)
+# the .model file holds the best policy only: training is resumed from the last epoch in the .checkpoint file
+checkpoint_file = opt.model_file + '.checkpoint'
+if os.path.isfile(checkpoint_file):
+    print(f'[loading previous checkpoint: {checkpoint_file}]')
+    checkpoint = torch.load(checkpoint_file)
+    policy = checkpoint['model']
+    policy.intype('gpu')
+    optimizer = optim.Adam(policy.parameters(), opt.lrt, eps=1e-3)
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    n_iter = checkpoint['n_iter']
+    best_valid_loss = checkpoint['best_valid_loss']
+    dataloader.load_state_dict(checkpoint['sampler'])
+    utils.log(opt.model_file + '.log', '[resuming from checkpoint]')
+else:
+    policy = models.PolicyMDN(opt, npred=opt.npred)
+    policy.intype('gpu')
+    optimizer = optim.Adam(policy.parameters(), opt.lrt, eps=1e-3)
+    n_iter = 0
+    best_valid_loss = 1e6
 
 def train(nbatches):
     policy.train()
     total_loss, nb = 0, 0
-    for i in range(nbatches):
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('train', nbatches):
         optimizer.zero_grad()
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('train')
         pi, mu, sigma, _ = policy(inputs[0], inputs[1])
         loss = utils.mdn_loss_fn(pi, sigma, mu, actions.view(opt.batch_size, -1))
         if not math.isnan(loss.item()):
@@ -94,8 +113,7 @@ def train(nbatches):
 def test(nbatches):
     policy.eval()
     total_loss, nb = 0, 0
-    for i in range(nbatches):
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('valid')
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('valid', nbatches):
         pi, mu, sigma, _ = policy(inputs[0], inputs[1])
         loss = utils.mdn_loss_fn(pi, sigma, mu, actions.view(opt.batch_size, -1))
         if not math.isnan(loss.item()):
@@ -110,23 +128,31 @@ def test(nbatches):
 writer = utils.create_tensorboard_writer(opt)
 
 print('[training]')
-best_valid_loss = 1e6
 for i in range(200):
+    dataloader.set_epoch(n_iter // opt.epoch_size)
     train_loss = train(opt.epoch_size)
     valid_loss = test(opt.epoch_size)
+    n_iter += opt.epoch_size
+    policy.intype('cpu')
     if valid_loss < best_valid_loss:
         best_valid_loss = valid_loss
-        policy.intype('cpu')
         torch.save(policy, opt.model_file + '.model')
-        policy.intype('gpu')
+    torch.save({'model': policy,
+                'optimizer': optimizer.state_dict(),
+                'n_iter': n_iter,
+                'best_valid_loss': best_valid_loss,
+                'sampler': dataloader.state_dict()}, checkpoint_file)
+    policy.intype('gpu')
 
     if writer is not None:
         writer.add_scalar('Loss/train', train_loss, i)
         writer.add_scalar('Loss/valid', valid_loss, i)
 
-    log_string = f'iter {opt.epoch_size*i} | train loss: {train_loss:.5f}, valid: {valid_loss:.5f}, best valid loss: {best_valid_loss:.5f}'
+    log_string = f'iter {n_iter} | train loss: {train_loss:.5f}, valid: {valid_loss:.5f}, best valid loss: {best_valid_loss:.5f}'
     print(log_string)
     utils.log(opt.model_file + '.log', log_string)
+    if dataloader.cache is not None:
+        print(dataloader.cache)
 
     if writer is not None:
         writer.close()
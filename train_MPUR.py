@@ -86,6 +86,20 @@ model.opt.u_hinge = opt.u_hinge
 planning.estimate_uncertainty_stats(model, dataloader, n_batches=50, npred=opt.npred)
 model.eval()
 
+# resume the policy from a previous checkpoint, after the batches drawn by estimate_uncertainty_stats
+mfile = opt.model_file + '.model'
+if path.isfile(mfile):
+    print(f'[loading previous checkpoint: {mfile}]')
+    checkpoint = torch.load(mfile)
+    model.policy_net.load_state_dict(checkpoint['model'].policy_net.state_dict())
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    n_iter = checkpoint['n_iter']
+    if 'sampler' in checkpoint:
+        dataloader.load_state_dict(checkpoint['sampler'])
+    utils.log(opt.model_file + '.log', '[resuming from checkpoint]')
+else:
+    n_iter = 0
+
 
 def start(what, nbatches, npred):
     train = True if what is 'train' else False
@@ -100,8 +114,8 @@ def start(what, nbatches, npred):
         action=0,
         policy=0,
     )
-    for j in range(nbatches):
-        inputs, actions, targets, ids, car_sizes = dataloader.get_batch_fm(what, npred)
+    batches = dataloader.prefetch_batches(what, nbatches, npred)
+    for j, (inputs, actions, targets, ids, car_sizes) in enumerate(batches):
         pred, actions = planning.train_policy_net_mpur(
             model, inputs, targets, car_sizes, n_models=10, lrt_z=opt.lrt_z,
             n_updates_z=opt.z_updates, infer_z=opt.infer_z
@@ -141,7 +155,6 @@ def start(what, nbatches, npred):
 
 print('[training]')
 utils.log(opt.model_file + '.log', f'[job name: {opt.model_file}]')
-n_iter = 0
 losses = OrderedDict(
     p='proximity',
     l='lane',
@@ -154,6 +167,7 @@ losses = OrderedDict(
 writer = utils.create_tensorboard_writer(opt)
 
 for i in range(500):
+    dataloader.set_epoch(n_iter // opt.epoch_size)
     train_losses = start('train', opt.epoch_size, opt.npred)
     with torch.no_grad():  # Torch, please please please, do not track computations :)
         valid_losses = start('valid', opt.epoch_size // 2, opt.npred)
@@ -171,6 +185,7 @@ for i in range(500):
         optimizer=optimizer.state_dict(),
         opt=opt,
         n_iter=n_iter,
+        sampler=dataloader.state_dict(),
     ), opt.model_file + '.model')
     if (n_iter / opt.epoch_size) % 10 == 0:
         torch.save(dict(
@@ -187,6 +202,8 @@ for i in range(500):
     log_string += 'valid: [' + ', '.join(f'{k}: {valid_losses[v]:.4f}' for k, v in losses.items()) + ']'
     print(log_string)
     utils.log(opt.model_file + '.log', log_string)
+    if dataloader.cache is not None:
+        print(dataloader.cache)
 
 if writer is not None:
     writer.close()
@@ -32,6 +32,11 @@ parser.add_argument('-epoch_size', type=int, default=1000)
 parser.add_argument('-mfile', type=str, default='model=fwd-cnn-vae-fp-layers=3-bsize=64-ncond=20-npred=20-lrt=0.0001-nfeature=256-dropout=0.1-nz=32-beta=1e-06-zdropout=0.5-gclip=5.0-warmstart=1-seed=1.step200000.model')
 #parser.add_argument('-mfile', type=str, default='model=fwd-cnn-layers=3-bsize=64-ncond=20-npred=20-lrt=0.0001-nfeature=256-dropout=0.1-gclip=5.0-warmstart=0-seed=1.step200000.model')
 parser.add_argument('-debug', action='store_true')
+parser.add_argument('-num_workers', type=int, default=0, help='threads assembling batches ahead (0: synchronous)')
+parser.add_argument('-prefetch', type=int, default=4, help='max number of batches assembled ahead')
+parser.add_argument('-cache_size', type=int, default=0,
+                    help='MB of whole episodes cached in memory (0: read windows through the OS page cache)')
+parser.add_argument('-windows_per_episode', type=int, default=1, help='windows sampled from each episode')
 parser.add_argument('-enable_tensorboard', action='store_true',
                     help='Enables tensorboard logging.')
 parser.add_argument('-tensorboard_dir', type=str, default='models',
@@ -64,19 +69,34 @@ elif opt.layers == 4:
 opt.hidden_size = opt.nfeature*opt.h_height*opt.h_width
 
 model = torch.load(opt.model_dir + opt.mfile)
-cost = models.CostPredictor(opt).cuda()
 model.intype('gpu')
-optimizer = optim.Adam(cost.parameters(), opt.lrt)
 opt.model_file = opt.model_dir + opt.mfile + '.cost'
 print(f'[will save as: {opt.model_file}]')
 
+mfile = opt.model_file + '.model'
+
+# load previous checkpoint or create new cost regressor
+if os.path.isfile(mfile):
+    print(f'[loading previous checkpoint: {mfile}]')
+    checkpoint = torch.load(mfile)
+    cost = checkpoint['model'].cuda()
+    optimizer = optim.Adam(cost.parameters(), opt.lrt)
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    n_iter = checkpoint['n_iter']
+    if 'sampler' in checkpoint:
+        dataloader.load_state_dict(checkpoint['sampler'])
+    utils.log(opt.model_file + '.log', '[resuming from checkpoint]')
+else:
+    cost = models.CostPredictor(opt).cuda()
+    optimizer = optim.Adam(cost.parameters(), opt.lrt)
+    n_iter = 0
+
 
 def train(nbatches, npred):
     model.train()
     total_loss = 0
-    for i in range(nbatches):
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('train', nbatches, npred):
         optimizer.zero_grad()
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('train', npred)
         pred, _ = model(inputs, actions, targets, z_dropout=0)
         pred_cost = cost(pred[0].view(opt.batch_size*opt.npred, 1, 3, opt.height, opt.width), pred[1].view(opt.batch_size*opt.npred, 1, 4))
         loss = F.mse_loss(pred_cost.view(opt.batch_size, opt.npred, 2), targets[2])
@@ -94,8 +114,7 @@ def train(nbatches, npred):
 def test(nbatches, npred):
     model.train()
     total_loss = 0
-    for i in range(nbatches):
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('valid', npred)
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('valid', nbatches, npred):
         pred, _ = model(inputs, actions, targets, z_dropout=0)
         pred_cost = cost(pred[0].view(opt.batch_size*opt.npred, 1, 3, opt.height, opt.width), pred[1].view(opt.batch_size*opt.npred, 1, 4))
         loss = F.mse_loss(pred_cost.view(opt.batch_size, opt.npred, 2), targets[2])
@@ -110,16 +129,17 @@ writer = utils.create_tensorboard_writer(opt)
 
 
 print('[training]')
-n_iter = 0
 for i in range(200):
     t0 = time.time()
+    dataloader.set_epoch(n_iter // opt.epoch_size)
     train_loss = train(opt.epoch_size, opt.npred)
     valid_loss = test(int(opt.epoch_size / 2), opt.npred)
     n_iter += opt.epoch_size
     model.intype('cpu')
     torch.save({'model': cost,
                 'optimizer': optimizer.state_dict(),
-                'n_iter': n_iter}, opt.model_file + '.model')
+                'n_iter': n_iter,
+                'sampler': dataloader.state_dict()}, opt.model_file + '.model')
     if (n_iter/opt.epoch_size) % 10 == 0:
         torch.save({'model': cost,
                     'optimizer': optimizer.state_dict(),
@@ -132,6 +152,8 @@ for i in range(200):
     log_string = f'step {n_iter} | train: {train_loss} | valid: {valid_loss}' 
     print(log_string)
     utils.log(opt.model_file + '.log', log_string)
+    if dataloader.cache is not None:
+        print(dataloader.cache)
 
 if writer is not None:
     writer.close()
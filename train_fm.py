@@ -38,6 +38,11 @@ parser.add_argument('-grad_clip', type=float, default=5.0)
 parser.add_argument('-epoch_size', type=int, default=2000)
 parser.add_argument('-warmstart', type=int, default=0, help='initialize with pretrained model')
 parser.add_argument('-debug', action='store_true')
+parser.add_argument('-num_workers', type=int, default=0, help='threads assembling batches ahead (0: synchronous)')
+parser.add_argument('-prefetch', type=int, default=4, help='max number of batches assembled ahead')
+parser.add_argument('-cache_size', type=int, default=0,
+                    help='MB of whole episodes cached in memory (0: read windows through the OS page cache)')
+parser.add_argument('-windows_per_episode', type=int, default=1, help='windows sampled from each episode')
 parser.add_argument('-enable_tensorboard', action='store_true',
                     help='Enables tensorboard logging.')
 parser.add_argument('-tensorboard_dir', type=str, default='models',
@@ -94,6 +99,8 @@ if os.path.isfile(mfile):
     optimizer = optim.Adam(model.parameters(), opt.lrt)
     optimizer.load_state_dict(checkpoint['optimizer'])
     n_iter = checkpoint['n_iter']
+    if 'sampler' in checkpoint:
+        dataloader.load_state_dict(checkpoint['sampler'])
     utils.log(opt.model_file + '.log', '[resuming from checkpoint]')
 else:
     # specify deterministic model we use to initialize parameters with
@@ -151,9 +158,8 @@ def expand(x, actions, nrep):
 def train(nbatches, npred):
     model.train()
     total_loss_i, total_loss_s, total_loss_p = 0, 0, 0
-    for i in range(nbatches):
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('train', nbatches, npred):
         optimizer.zero_grad()
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('train', npred)
         pred, loss_p = model(inputs[: -1], actions, targets, z_dropout=opt.z_dropout)
         loss_p = loss_p[0]
         loss_i, loss_s = compute_loss(targets, pred)
@@ -180,9 +186,7 @@ def train(nbatches, npred):
 def test(nbatches):
     model.eval()
     total_loss_i, total_loss_s, total_loss_p = 0, 0, 0
-    for i in range(nbatches):
-        inputs, actions, targets, _, _ = dataloader.get_batch_fm('valid')
-
+    for inputs, actions, targets, _, _ in dataloader.prefetch_batches('valid', nbatches):
         pred, loss_p = model(inputs[: -1], actions, targets, z_dropout=opt.z_dropout)
         loss_p = loss_p[0]
         loss_i, loss_s = compute_loss(targets, pred)
@@ -203,6 +207,7 @@ writer = utils.create_tensorboard_writer(opt)
 print('[training]')
 for i in range(200):
     t0 = time.time()
+    dataloader.set_epoch(n_iter // opt.epoch_size)
     train_losses = train(opt.epoch_size, opt.npred)
     valid_losses = test(int(opt.epoch_size / 2))
 
@@ -219,7 +224,8 @@ for i in range(200):
     model.cpu()
     torch.save({'model': model,
                 'optimizer': optimizer.state_dict(),
-                'n_iter': n_iter}, opt.model_file + '.model')
+                'n_iter': n_iter,
+                'sampler': dataloader.state_dict()}, opt.model_file + '.model')
     if (n_iter/opt.epoch_size) % 10 == 0:
         torch.save(model, opt.model_file + f'.step{n_iter}.model')
     model.cuda()
@@ -228,6 +234,8 @@ for i in range(200):
     log_string += utils.format_losses(*valid_losses, split='valid')
     print(log_string)
     utils.log(opt.model_file + '.log', log_string)
+    if dataloader.cache is not None:
+        print(dataloader.cache)
 
 if writer is not None:
     writer.close()
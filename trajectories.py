@@ -0,0 +1,218 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+
+import numpy
+import pandas as pd
+
+# On-disk layout of a converted time slot of the NGSIM trajectories:
+#
+# traffic-data/xy-trajectories/<map>/<time_slot>.columns/
+# ├── meta.json         # format version, number of rows, columns (in the order of the text file) and their dtype,
+# │                     # size and mtime_ns of the file it was converted from
+# ├── vehicle_id.bin    # (n_rows,) one flat array per column, rows in the order of the text file
+# ├── frame_id.bin
+# ├── ...
+# └── <name>/           # data frames derived from the time slot (see shared_frame), same layout
+#
+# Columns are those of the text files, which differ between highways (I-80, US-101) and arterials (Lankershim,
+# Peachtree). Every column is stored with the narrowest dtype holding all of its values exactly: int32 (int64 if
+# needed) for integers, float32 for floats if it represents all of them, float64 otherwise (e.g. positions, with
+# three decimals). Hence no precision is lost, unlike the float16 pickles of earlier versions, and floats are read
+# back as float64, so that the simulation does not depend on how a time slot was stored.
+#
+# Derived data frames (e.g. the rows on screen of a map) are stored as they are in memory, so that they are opened
+# memory-mapped read-only without any copy: environments of the same process get the same data frame, and those of
+# different processes share its pages, so memory does not grow with the number of environments.
+
+DATA_DIR = 'traffic-data/xy-trajectories'
+COLUMNS_DIR = '.columns'
+VERSION = 1
+
+HIGHWAY_COLUMNS = (
+    'Vehicle ID',
+    'Frame ID',
+    'Total Frames',
+    'Global Time',
+    'Local X',
+    'Local Y',
+    'Global X',
+    'Global Y',
+    'Vehicle Length',
+    'Vehicle Width',
+    'Vehicle Class',
+    'Vehicle Velocity',
+    'Vehicle Acceleration',
+    'Lane Identification',
+    'Preceding Vehicle',
+    'Following Vehicle',
+    'Spacing',
+    'Headway'
+)
+ARTERIAL_COLUMNS = HIGHWAY_COLUMNS[:14] + (
+    'Origin Zone',
+    'Destination Zone',
+    'Intersection',
+    'Section',
+    'Direction',
+    'Movement',
+) + HIGHWAY_COLUMNS[14:]
+MAP_COLUMNS = {
+    'i80': HIGHWAY_COLUMNS,
+    'us101': HIGHWAY_COLUMNS,
+    'lanker': ARTERIAL_COLUMNS,
+    'peach': ARTERIAL_COLUMNS,
+}
+
+
+def _file_name(column):
+    return column.lower().replace(' ', '_') + '.bin'
+
+
+def _narrowest_dtype(values):
+    if numpy.issubdtype(values.dtype, numpy.integer):
+        info = numpy.iinfo(numpy.int32)
+        return 'int32' if len(values) == 0 or info.min <= values.min() and values.max() <= info.max else 'int64'
+    values = values.astype(numpy.float64)
+    return 'float32' if numpy.array_equal(values.astype(numpy.float32), values, equal_nan=True) else 'float64'
+
+
+def _source(time_slot):
+    # the text file, or else the (lossy) pickle of an earlier version
+    for extension in '.txt', '.pkl':
+        file_name = os.path.join(DATA_DIR, time_slot + extension)
+        if os.path.isfile(file_name): return file_name
+    return None
+
+
+def read_text(time_slot):
+    """
+    Parse the text file of a time slot
+    :param time_slot: e.g. i80/trajectories-0400-0415
+    """
+    file_name = os.path.join(DATA_DIR, f'{time_slot}.txt')
+    names = MAP_COLUMNS[time_slot.split('/')[0]]
+    return pd.read_csv(file_name, sep=r'\s+', header=None, names=names)
+
+
+def convert(time_slot, force=False):
+    """
+    Convert the text file of a time slot (or its pickle, if there is no text file) into columns
+    :param time_slot: e.g. i80/trajectories-0400-0415
+    :param force: convert it again, even if the columns are up to date
+    :return: path of the columns
+    """
+    path = os.path.join(DATA_DIR, time_slot + COLUMNS_DIR)
+    file_name = _source(time_slot)
+    if file_name is None and not os.path.isfile(os.path.join(path, 'meta.json')):
+        raise FileNotFoundError(f'{os.path.join(DATA_DIR, time_slot)}.{{txt,pkl}} not found.')
+    if file_name is None: return path  # columns without their source
+    stat = os.stat(file_name)
+    source = dict(file=os.path.basename(file_name), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    meta = _read_meta(path)
+    if not force and meta is not None and meta['source'] == source: return path
+
+    print(f'[converting {file_name}]')
+    df = read_text(time_slot) if file_name.endswith('.txt') else pd.read_pickle(file_name)
+    _write_columns(path, {column: df[column].values.astype(_narrowest_dtype(df[column].values))
+                          for column in df.columns}, source)
+    return path
+
+
+def _write_columns(path, columns, source):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for column, values in columns.items():
+        values.tofile(os.path.join(tmp_path, _file_name(column)))
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(dict(version=VERSION, n_rows=n_rows, columns={c: v.dtype.name for c, v in columns.items()},
+                       source=source), f, indent=2)
+    publish(tmp_path, path, lambda: (_read_meta(path) or dict()).get('source') == source)
+
+
+def publish(tmp_path, path, up_to_date):
+    """
+    Move the directory tmp_path to path atomically, so that processes reading path never see it half written
+    :param up_to_date: function telling whether path, if it exists, can be kept (e.g. another process has just
+                       published the same data there), so that files other processes are reading are not replaced
+    """
+    for _ in range(2):
+        try:
+            os.rename(tmp_path, path)
+            return
+        except OSError:  # path exists
+            if up_to_date(): break
+            shutil.rmtree(path, ignore_errors=True)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _open_columns(path, meta, columns=None):
+    print(f'Loading trajectories from {path}')
+    return {column: numpy.memmap(os.path.join(path, _file_name(column)), dtype=dtype, mode='r', shape=(meta['n_rows'],))
+            for column, dtype in meta['columns'].items() if columns is None or column in columns}
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == VERSION else None
+
+
+def load(time_slot, columns=None):
+    """
+    Data frame of a time slot, read from its columns (converted first, if missing or out of date)
+    :param time_slot: e.g. i80/trajectories-0400-0415
+    :param columns: columns to read, all of them if None
+    :return: pandas.DataFrame, with integers as stored and floats as float64
+    """
+    path = convert(time_slot)
+    df = _open_columns(path, _read_meta(path), columns)
+    return pd.DataFrame({column: values.astype(numpy.float64 if values.dtype.kind == 'f' else values.dtype)
+                         for column, values in df.items()}, copy=False)
+
+
+_shared_frames = dict()  # path -> data frame, for all the environments of this process
+
+
+def shared_frame(time_slot, name, make):
+    """
+    Data frame made from a time slot, saved next to its columns the first time, and then shared read-only
+    :param time_slot: e.g. i80/trajectories-0400-0415
+    :param name: identifies make() and its parameters, e.g. on-screen-470-2040
+    :param make: function of the data frame returned by load(time_slot), returning a new data frame
+    :return: pandas.DataFrame memory-mapped read-only, the same one for every call in this process
+    """
+    base = convert(time_slot)
+    path = os.path.join(base, name)
+    if path not in _shared_frames:
+        source = _read_meta(base)['source']
+        meta = _read_meta(path)
+        if meta is None or meta['source'] != source:
+            df = make(load(time_slot))
+            _write_columns(path, {column: numpy.ascontiguousarray(df[column].values) for column in df.columns},
+                           source)
+            meta = _read_meta(path)
+        _shared_frames[path] = pd.DataFrame(_open_columns(path, meta), copy=False)
+    return _shared_frames[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-maps', type=str, nargs='+', default=list(MAP_COLUMNS), help='maps to convert')
+    parser.add_argument('-force', action='store_true', help='convert again the time slots already converted')
+    opt = parser.parse_args()
+
+    for map_ in opt.maps:
+        file_names = glob.glob(os.path.join(DATA_DIR, map_, '*.txt')) + glob.glob(os.path.join(DATA_DIR, map_, '*.pkl'))
+        for time_slot in sorted({os.path.relpath(os.path.splitext(f)[0], DATA_DIR) for f in file_names}):
+            path = convert(time_slot, force=opt.force)
+            meta = _read_meta(path)
+            size = sum(os.path.getsize(os.path.join(path, _file_name(c))) for c in meta['columns'])
+            print(f'[{time_slot}: {meta["n_rows"]} rows, {size / 2**20:.1f} MB]')
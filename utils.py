@@ -510,6 +510,11 @@ def parse_command_line(parser=None):
     parser.add_argument('-load_model_file', type=str, default='')
     parser.add_argument('-combine', type=str, default='add')
     parser.add_argument('-debug', action='store_true')
+    parser.add_argument('-num_workers', type=int, default=0, help='threads assembling batches ahead (0: synchronous)')
+    parser.add_argument('-prefetch', type=int, default=4, help='max number of batches assembled ahead')
+    parser.add_argument('-cache_size', type=int, default=0,
+                        help='MB of whole episodes cached in memory (0: read windows through the OS page cache)')
+    parser.add_argument('-windows_per_episode', type=int, default=1, help='windows sampled from each episode')
     parser.add_argument('-save_movies', action='store_true')
     parser.add_argument('-l2reg', type=float, default=0.0)
     parser.add_argument('-no_cuda', action='store_true')
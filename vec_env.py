@@ -0,0 +1,184 @@
+import torch
+
+
+class VecEnv:
+    """
+    K independent episodes of a controlled simulator (e.g. map_i80_ctrl.ControlledI80), stepped in lockstep within one
+    process, so that a policy acts on all of them with a single batched forward pass per frame
+
+    Observations are stacked: context (K, ncond, 4, 117, 24) and state (K, ncond, 4). A finished episode is reset right
+    away to the next one: step() then returns the first observation of the new episode, while the last observation of
+    the finished one is in its info. When there are no more episodes to play, an environment stays done (see active).
+    """
+
+    def __init__(self, envs, episodes=None):
+        """
+        :param envs: K simulators, whose reset() returns the first observation of a controlled car
+        :param episodes: iterable of reset() keyword arguments (e.g. dict(time_slot=0, vehicle_id=1234)), one per
+                         episode, dealt to the environments as they finish; None for endless random episodes
+        """
+        self.envs = envs
+        self.episodes = iter(episodes) if episodes is not None else None
+        self.active = [True] * len(envs)  # False, once an environment has no more episodes to play
+        self.episode = [None] * len(envs)  # reset() keyword arguments of the current episode of every environment
+        self.observation = None  # stacked observations, allocated with the first one
+        self.cost = [None] * len(envs)
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self):
+        """
+        Start a new episode in every environment
+        :return: stacked observations
+        """
+        for k in range(len(self)):
+            self._reset(k)
+        return self.observation
+
+    def _reset(self, k):
+        episode = dict() if self.episodes is None else next(self.episodes, None)
+        if episode is None:
+            self.active[k] = False
+            return
+        self.episode[k] = episode
+        self._store(k, self.envs[k].reset(**episode))
+
+    def _store(self, k, observation):
+        if self.observation is None:
+            self.observation = {key: torch.zeros(len(self), *x.shape, dtype=x.dtype) for key, x in observation.items()}
+        for key, x in observation.items():
+            self.observation[key][k].copy_(x)
+
+    def step(self, actions):
+        """
+        Step every environment, and reset the ones whose episode is over
+        :param actions: (K, 2) actions, one per environment (ignored for the inactive ones)
+        :return: stacked observations (overwritten by the next step), costs of the last step as (K,) tensors (NaN if
+                 never stepped), (K,) dones, and K infos: controlled car, episode and (if done) last observation
+        """
+        actions = torch.as_tensor(actions).detach().cpu().numpy()
+        dones = torch.zeros(len(self), dtype=torch.bool)
+        infos = [dict() for _ in range(len(self))]
+        for k, env in enumerate(self.envs):
+            if not self.active[k]:
+                dones[k] = True
+                continue
+            observation, cost, done, car = env.step(actions[k].copy())  # normalise_action works in place
+            infos[k].update(car=car, episode=self.episode[k])
+            if observation is None:  # the controlled car is gone already
+                done = True
+            else:
+                self._store(k, observation)
+                self.cost[k] = cost
+            if done:
+                dones[k] = True
+                infos[k]['last_observation'] = {key: x[k].clone() for key, x in self.observation.items()}
+                self._reset(k)
+        keys = next(c for c in self.cost + [dict()] if c is not None)
+        costs = {key: torch.tensor([float(c[key]) if c else float('nan') for c in self.cost]) for key in keys}
+        return self.observation, costs, dones, infos
+
+
+def _car_summary(car):
+    # what evaluators read from the controlled car, without pickling the car and its history
+    return dict(id=car.id, off_screen=car.off_screen, arrived_to_dst=car.arrived_to_dst,
+                collisions_per_frame=car.collisions_per_frame)
+
+
+def _worker(pipe, make_env, n_envs, episodes):
+    torch.set_num_threads(1)  # one core per worker
+    envs = VecEnv([make_env() for _ in range(n_envs)], None if episodes is None else iter(episodes.get, None))
+    while True:
+        command, data = pipe.recv()
+        if command == 'reset':
+            envs.reset()
+            pipe.send(None if envs.observation is None else
+                      {key: (x.shape[1:], x.dtype) for key, x in envs.observation.items()})
+        elif command == 'share':  # from now on, observations are written straight into the parent's tensors
+            if envs.observation is not None:
+                for key, x in data.items(): x.copy_(envs.observation[key])
+            envs.observation = data
+            pipe.send(None)
+        elif command == 'step':
+            _, costs, dones, infos = envs.step(data)
+            for info in infos:
+                if info.get('car') is not None: info['car'] = _car_summary(info['car'])
+            pipe.send((costs, dones, infos, envs.active))
+        elif command == 'close':
+            pipe.close()
+            break
+
+
+class SubprocVecEnv:
+    """
+    VecEnv whose K environments are spread over worker processes, each one stepping its share of them in lockstep
+
+    Workers write observations straight into tensors in shared memory, which are stacked as in VecEnv, so that only
+    actions, costs and dones go through the pipes. Infos carry a summary of the controlled car instead of the car.
+    """
+
+    def __init__(self, make_env, n_envs, n_workers, episodes=None, context='spawn'):
+        """
+        :param make_env: picklable function building a simulator, e.g. functools.partial(ControlledI80, **kwargs)
+        :param n_envs: number of environments (K)
+        :param n_workers: number of worker processes
+        :param episodes: as in VecEnv, dealt to the workers as their environments finish
+        :param context: multiprocessing start method
+        """
+        ctx = torch.multiprocessing.get_context(context)
+        self.episodes = None  # kept alive as long as the workers
+        if episodes is not None:
+            self.episodes = ctx.Queue()
+            for episode in episodes: self.episodes.put(episode)
+            for _ in range(n_workers): self.episodes.put(None)  # no more episodes
+        sizes = [n_envs // n_workers + (w < n_envs % n_workers) for w in range(n_workers)]
+        self.slices = [slice(sum(sizes[:w]), sum(sizes[:w + 1])) for w in range(n_workers) if sizes[w]]
+        self.pipes, self.workers = list(), list()
+        for s in self.slices:
+            pipe, worker_pipe = ctx.Pipe()
+            worker = ctx.Process(target=_worker, args=(worker_pipe, make_env, s.stop - s.start, self.episodes),
+                                 daemon=True)
+            worker.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.workers.append(worker)
+        self.n_envs = n_envs
+        self.active = [True] * n_envs
+        self.observation = None
+
+    def __len__(self):
+        return self.n_envs
+
+    def reset(self):
+        """
+        Start a new episode in every environment
+        :return: stacked observations, in shared memory
+        """
+        for pipe in self.pipes: pipe.send(('reset', None))
+        shapes = [pipe.recv() for pipe in self.pipes]
+        if self.observation is None:
+            shape = next(s for s in shapes + [None] if s is not None)
+            if shape is None: raise RuntimeError('no episode to play')
+            self.observation = {key: torch.zeros(len(self), *s, dtype=dtype).share_memory_()
+                                for key, (s, dtype) in shape.items()}
+            for pipe, s in zip(self.pipes, self.slices):
+                pipe.send(('share', {key: x[s] for key, x in self.observation.items()}))
+            for pipe in self.pipes: pipe.recv()
+        return self.observation
+
+    def step(self, actions):
+        """
+        Same as VecEnv.step
+        """
+        actions = torch.as_tensor(actions).detach().cpu().numpy()
+        for pipe, s in zip(self.pipes, self.slices): pipe.send(('step', actions[s]))
+        costs, dones, infos, active = zip(*(pipe.recv() for pipe in self.pipes))
+        self.active = [a for worker_active in active for a in worker_active]
+        nan = [torch.full((s.stop - s.start,), float('nan')) for s in self.slices]  # workers with no episode
+        costs = {key: torch.cat([c.get(key, n) for c, n in zip(costs, nan)]) for key in next(filter(None, costs), ())}
+        return self.observation, costs, torch.cat(dones), [info for worker_infos in infos for info in worker_infos]
+
+    def close(self):
+        for pipe in self.pipes: pipe.send(('close', None))
+        for worker in self.workers: worker.join()